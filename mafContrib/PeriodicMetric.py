@@ -7,8 +7,9 @@
 
 from lsst.sims.maf.metrics import BaseMetric
 import numpy as np
+from .sliceDedup import DedupMetricMixin
 
-class PeriodMetric(BaseMetric):
+class PeriodMetric(DedupMetricMixin, BaseMetric):
    """
    From a set of observation times, uses code provided by Robert Siverd (LCOGT) to calculate the spectral window function.
    """
@@ -16,7 +17,7 @@ class PeriodMetric(BaseMetric):
       self.TimeCol=TimeCol
       super(PeriodMetric, self).__init__(col=[self.TimeCol], **kwargs)
 
-   def run(self, dataSlice, slicePoint=None):
+   def _run(self, dataSlice):
       frq_pts = 30000.0
       max_frq =    25.0
       times=dataSlice[self.TimeCol]
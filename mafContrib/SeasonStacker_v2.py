@@ -30,31 +30,103 @@ class SeasonStacker_v2(BaseStacker):
         # And save the column names.
         self.expMJDCol = expMJDCol
         self.RACol = RACol
-                
-    def run(self, simData):
-        # Add new columns to simData.
-        simData = self._addStackers(simData)
-        # Define year number:
-        year = np.floor((simData[self.expMJDCol] - simData[self.expMJDCol][0]) / 365.25)
+        # The year/season anchors, set by computeSeasons/run and kept so that visits appended later
+        # can be labelled on their own.
+        self.yearAnchor = None
+        self.seasonAnchor = None
 
-        objRA= simData[self.RACol]*rad2deg/15.0   # in hrs
+    def firstSeasonBegan(self, RA):
+        """
+        Return the MJD at which the first season began for objects at RA (radians).
+        """
+        objRA= RA*rad2deg/15.0   # in hrs
             
         # objRA=0 on autumnal equinox.
         # autumnal equinox 2014 happened on Sept 23 --> Equinox MJD
         Equinox = 2456923.5 - 2400000.5
 
         daysSinceEquinox = 0.5*objRA*(365.25/12.0)  # 0.5 to go from RA to month; 365.25/12.0 for months to days
-        firstSeasonBegan = Equinox + daysSinceEquinox - 0.5*365.25   # in MJD
+        return Equinox + daysSinceEquinox - 0.5*365.25   # in MJD
+
+    def computeSeasons(self, expMJD, RA):
+        """
+        Return the integer year and season labels of visits taken at expMJD (days) and RA (radians),
+        without adding them to (and so copying) simData.
+        """
+        # Define year number, counted from the first visit:
+        self.yearAnchor = expMJD[0]
+        year = np.floor((expMJD - self.yearAnchor) / 365.25).astype(int)
+
+        firstSeasonBegan = self.firstSeasonBegan(RA)
         
         # Now we can compute the number of years since the first season 
         # began, and so assign a global integer season number:
-        globalSeason = np.floor((simData[self.expMJDCol] - firstSeasonBegan)/365.25)
+        globalSeason = np.floor((expMJD - firstSeasonBegan)/365.25).astype(int)
         # Subtract off season number of first observation:
-        season = globalSeason - np.min(globalSeason) 
-        
-        simData['year'] = year
-        simData['season'] = season
+        self.seasonAnchor = np.min(globalSeason)
+        season = globalSeason - self.seasonAnchor
+
+        return year, season
+
+    def computeAppendedSeasons(self, expMJD, RA):
+        """
+        Return the integer year and season labels of visits appended to the ones last labelled by
+        computeSeasons/run (or restored with loadState), without reprocessing the earlier visits.
+        The labels are identical to those from rerunning computeSeasons on the full table.
+        """
+        if self.yearAnchor is None:
+            raise ValueError('No visits labelled yet: must run computeSeasons/run (or loadState) first.')
+        # Define year number, counted from the first visit:
+        year = np.floor((expMJD - self.yearAnchor) / 365.25).astype(int)
+
+        firstSeasonBegan = self.firstSeasonBegan(RA)
+
+        globalSeason = np.floor((expMJD - firstSeasonBegan)/365.25).astype(int)
+        # A new earliest season would shift the labels of all the earlier visits too.
+        if (len(globalSeason) > 0) and (np.min(globalSeason) < self.seasonAnchor):
+            raise ValueError('Appended visits fall in a season before the first one labelled so far: '
+                             'must rerun on the full table.')
+        season = globalSeason - self.seasonAnchor
+
+        return year, season
+
+    def run(self, simData):
+        # Add new columns to simData.
+        simData = self._addStackers(simData)
+        simData['year'], simData['season'] = self.computeSeasons(simData[self.expMJDCol], simData[self.RACol])
+
+        return simData
+
+    def runAppended(self, simData):
+        """
+        Add the year and season columns to simData, which holds only the visits appended since
+        the last run (e.g. the latest night of a running survey).
+        """
+        simData = self._addStackers(simData)
+        simData['year'], simData['season'] = self.computeAppendedSeasons(simData[self.expMJDCol],
+                                                                         simData[self.RACol])
 
         return simData
 
+    def saveState(self, filename):
+        """
+        Save the year/season anchors to filename (npz), so that runAppended can be used in a later session.
+        """
+        # Before any visit is labelled there are no anchors: save a flag and placeholders instead of None.
+        hasAnchors = self.yearAnchor is not None
+        np.savez(filename, hasAnchors=hasAnchors, yearAnchor=self.yearAnchor if hasAnchors else np.nan,
+                 seasonAnchor=self.seasonAnchor if hasAnchors else 0)
+
+    def loadState(self, filename):
+        """
+        Restore the state saved by saveState.
+        """
+        state = np.load(filename)
+        if bool(state['hasAnchors']):
+            self.yearAnchor = float(state['yearAnchor'])
+            self.seasonAnchor = int(state['seasonAnchor'])
+        else:
+            self.yearAnchor = None
+            self.seasonAnchor = None
+
 ###############################################################################################
@@ -7,8 +7,9 @@
 
 from lsst.sims.maf.metrics import BaseMetric
 import numpy as np
+from .sliceDedup import DedupMetricMixin
 
-class TripletMetric(BaseMetric):
+class TripletMetric(DedupMetricMixin, BaseMetric):
    """
    Find the number of 'triplets' of three images taken in any band, based on user-selected minimum and maximum intervals (in hours), as well as constraining the ratio of the two exposures intervals. Triplets are not required to be consecutive observations and may be overlapping.
    """
@@ -20,7 +21,7 @@ class TripletMetric(BaseMetric):
       self.ratiomin=kwargs.pop('RatioMin', 1)
       super(TripletMetric, self).__init__(col=[self.TimeCol], **kwargs)
 
-   def run(self, dataSlice, slicePoint=None):
+   def _run(self, dataSlice):
       times=dataSlice[self.TimeCol]
       times=times-49378 #change times to smaller numbers
       delmax=self.delmax
@@ -45,26 +46,42 @@ class TripletMetric(BaseMetric):
 
 
 
-class TripletBandMetric(BaseMetric):
+class TripletBandMetric(DedupMetricMixin, BaseMetric):
    """
    Find the number of 'triplets' of three images taken in the same band, based on user-selected minimum and maximum intervals (in hours), as well as constraining the ratio of the two exposures intervals. Triplets are not required to be consecutive observations and may be overlapping.
    """
-   def __init__(self, TimeCol='expMJD', FilterCol='filter', **kwargs):
+   def __init__(self, TimeCol='expMJD', FilterCol='filter', FilterCodeCol=None, **kwargs):
       self.TimeCol=TimeCol
       self.FilterCol=FilterCol
+      #optionally, the filter code column of FilterCodeStacker can be used instead of the filter names
+      self.FilterCodeCol=FilterCodeCol
+      if FilterCodeCol is not None:
+         FilterCol=FilterCodeCol
       self.delmin=kwargs.pop('DelMin', 1)/24. #convert minutes to hours
       self.delmax=kwargs.pop('DelMax', 12)/24. #convert minutes to hours
       self.ratiomax=kwargs.pop('RatioMax', 1000)
       self.ratiomin=kwargs.pop('RatioMin', 1)
-      super(TripletBandMetric, self).__init__(col=[self.TimeCol, self.FilterCol], **kwargs)
+      super(TripletBandMetric, self).__init__(col=[self.TimeCol, FilterCol], **kwargs)
       self.reduceOrder = {'Bandu':0, 'Bandg':1, 'Bandr':2, 'Bandi':3, 'Bandz':4, 'Bandy':5}
 
-   def run(self, dataSlice, slicePoint=None):
+   def _run(self, dataSlice):
       times=dataSlice[self.TimeCol]
       times=times-49378 #change times to smaller numbers
-      bands=dataSlice[self.FilterCol]
       bandset=['u','g','r','i','z','y'] #list of possible bands
       timedict={}
+      if self.FilterCodeCol is not None:
+         #group the exposures by filter code in one stable sort, instead of comparing strings per band
+         codes=dataSlice[self.FilterCodeCol]
+         sortedtimes=times[np.argsort(codes, kind='mergesort')]
+         bandcounts=np.bincount(codes, minlength=len(bandset))
+         bandends=np.cumsum(bandcounts)
+         bandstarts=bandends-bandcounts
+         for (code, band) in enumerate(bandset):
+            timedict[band]=sortedtimes[bandstarts[code]:bandends[code]]
+      else:
+         bands=dataSlice[self.FilterCol]
+         for band in bandset:
+            timedict[band]=times[np.where(band==bands)]
       delmax=self.delmax
       delmin=self.delmin
       ratiomax=self.ratiomax
@@ -72,9 +89,7 @@ class TripletBandMetric(BaseMetric):
       bandcounter={'u':0, 'g':0, 'r':0, 'i':0, 'z':0, 'y':0} #define zeroed out counter
       #iterate over each bandpass
       for band in bandset:
-         indexlist=np.where(band==bands)
-         timedict[band]=times[indexlist]
-         #create a data set of all exposures for a single band
+         #the data set of all exposures for a single band
          timeband=timedict[band]
          #iterate over every exposure time
          for (counter, time) in enumerate(timeband):
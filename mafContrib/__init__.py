@@ -11,8 +11,13 @@ from .TripletMetric import *
 
 from .varMetrics import *
 
+from .slicePointCache import *
+from .sliceDedup import *
+from .batchSlices import *
 from .lssMetrics import *
 from .nFollowStacker import *
+from .filterCodeStacker import *
+from .nightSummaryStacker import *
 
 from photPrecMetrics import *
 from .CountMassMetric import *
@@ -20,5 +25,6 @@ from .CountMetric import *
 from .PeriodicMetric import *
 
 from .SeasonStacker_v2 import *
+from .ditherPatterns import *
 from .newDitherStackers import *
 from .maskingAlgorithmGeneralized import *
@@ -0,0 +1,74 @@
+###############################################################################################################
+# Motivation: at high nside, calling a cheap metric once per slicepoint is dominated by the python overhead
+# of the call. Metrics with a runBatch(dataSlices, offsets) method compute many slices at once instead, from
+# a ragged (CSR-like) representation: the slices concatenated into one array, and the offsets where each
+# slice begins (slice i is dataSlices[offsets[i]:offsets[i+1]]). The grouped reductions shared by these metrics
+# (and by their one-slice run methods) are here too.
+###############################################################################################################
+import numpy as np
+
+__all__ = ['concatenateSlices', 'sliceIds', 'groupStarts', 'seasonStatistics']
+
+def concatenateSlices(sliceList):
+    """
+    Return the (dataSlices, offsets) ragged representation of a list of data slices, for runBatch.
+    """
+    lengths = [len(dataSlice) for dataSlice in sliceList]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(int)
+    return np.concatenate(sliceList), offsets
+
+def sliceIds(offsets):
+    """
+    Return, for each row of the concatenated dataSlices, the number of the slice it belongs to.
+    """
+    offsets = np.asarray(offsets)
+    return np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+
+def groupStarts(*keys):
+    """
+    Return a boolean array, true at the first row and wherever any of the keys (arrays sorted so that equal
+    keys are adjacent) differs from the row before: the rows where each group of equal keys begins.
+    """
+    newGroup = np.zeros(len(keys[0]), bool)
+    if len(newGroup) > 0:
+        newGroup[0] = True
+        for key in keys:
+            newGroup[1:] |= (key[1:] != key[:-1])
+    return newGroup
+
+def seasonStatistics(seasons, expMJD=None, nights=None, slices=None):
+    """
+    Group the visits by season (within each slice, if the slice of each visit is given in slices), and
+    return, with one entry per group:
+    the slice of the group (all 0 without slices),
+    the end-to-end length of the season in days (if expMJD is given, otherwise None),
+    the mean separation in days between its consecutive distinct nights, 0.0 if there is only one
+    (if nights is given, otherwise None).
+    """
+    if slices is None:
+        slices = np.zeros(len(seasons), int)
+    if len(seasons) == 0:
+        empty = np.zeros(0)
+        return (np.zeros(0, int), None if expMJD is None else empty, None if nights is None else empty)
+    # Sort by slice and season (and night within each season, if needed) once.
+    if nights is None:
+        order = np.lexsort((seasons, slices))
+    else:
+        order = np.lexsort((nights, seasons, slices))
+    slices = slices[order]
+    newSeason = groupStarts(slices, seasons[order])
+    seasonStart = np.where(newSeason)[0]
+    lengths = None
+    if expMJD is not None:
+        dates = expMJD[order]
+        lengths = np.maximum.reduceat(dates, seasonStart) - np.minimum.reduceat(dates, seasonStart)
+    separations = None
+    if nights is not None:
+        # The mean separation between consecutive distinct nights is just
+        # (last night - first night) / (number of distinct nights - 1).
+        nights = nights[order]
+        seasonEnd = np.concatenate((seasonStart[1:], [len(order)])) - 1
+        nNights = np.add.reduceat((newSeason | groupStarts(nights)).astype(int), seasonStart)
+        separations = np.where(nNights > 1,
+                               (nights[seasonEnd] - nights[seasonStart])/np.maximum(nNights-1, 1.), 0.0)
+    return slices[seasonStart], lengths, separations
@@ -4,6 +4,7 @@
 
 from lsst.sims.maf.metrics import BaseMetric
 import numpy as np
+from .batchSlices import sliceIds, groupStarts
 
 
 class CampaignLengthMetric(BaseMetric):
@@ -33,4 +34,19 @@ class CampaignLengthMetric(BaseMetric):
         # print "seasons, count:",seasons,count
         return count
 
+    def runBatch(self, dataSlices, offsets):
+        """
+        Return the metric values of many slices at once: slice i is dataSlices[offsets[i]:offsets[i+1]].
+        """
+        if len(dataSlices) == 0:
+            # Every slice is empty, as run() gives no seasons.
+            return np.zeros(len(offsets)-1, int)
+        slices = sliceIds(offsets)
+        # Sort by slice and season together, and count the seasons that begin in each slice:
+        order = np.lexsort((dataSlices[self.seasonCol], slices))
+        seasons = dataSlices[self.seasonCol][order]
+        slices = slices[order]
+        newSeason = groupStarts(slices, seasons)
+        return np.bincount(slices[newSeason], minlength=len(offsets)-1)
+
 # ======================================================================
@@ -0,0 +1,175 @@
+##############################################################################################################
+# Motivation: a library of the dither offset patterns used by the stackers in newDitherStackers.
+
+# The deterministic patterns (spiral, hexagonal grid, pentagons) only depend on a handful of parameters, so
+# they are computed once for each (pattern, maxDither, numPoints, nCoils) and shared by all stacker instances.
+# The random patterns are drawn fresh on every call, but live here too so that all the stackers get their
+# offsets from the same place.
+###############################################################################################################
+import numpy as np
+
+__all__ = ['ditherOffsets', 'randomHexOffsets', 'repulsiveRandomHexOffsets']
+
+# memoized offsets for the deterministic patterns, keyed by (pattern, maxDither, numPoints, nCoils).
+_offsetCache = {}
+
+def polygonCoords(nside, radius, rotationAngle):
+    """
+    Find the x,y coords of a polygon.
+    """
+    eachAngle= 2*np.pi/nside
+    angles= eachAngle*np.arange(nside) + rotationAngle
+    xCoords= np.sin(angles)*radius
+    yCoords= np.cos(angles)*radius
+
+    return zip(xCoords,yCoords)
+
+def _spiralOffsets(maxDither, numPoints, nCoils):
+    # First generate a full archimedean spiral ..
+    theta = np.arange(0.0001, nCoils*np.pi*2., 0.001)
+    a = 0.85*maxDither/theta.max()
+    r = theta*a
+    # Then pick out equidistant points along the spiral.
+    arc = a / 2.0 *(theta * np.sqrt(1 + theta**2) + np.log(theta + np.sqrt(1 + theta**2)))
+    stepsize = arc.max()/float(numPoints)
+    arcpts = np.arange(0, arc.max(), stepsize)
+    arcpts = arcpts[0:numPoints]
+    # arc increases monotonically, so the closest spiral sample to each point is one of the two samples
+    # bracketing it; take the lower one on ties, as argmin would.
+    match = np.clip(np.searchsorted(arc, arcpts), 1, len(arc)-1)
+    match[(arcpts - arc[match-1]) <= (arc[match] - arcpts)] -= 1
+    # Translate these r/theta points into x/y (ra/dec) offsets.
+    return r[match] * np.cos(theta[match]), r[match] * np.sin(theta[match])
+
+def _hexOffsets(maxDither):
+    # Set up basics of dither pattern.
+    dith_level = 4
+    nrows = 2**dith_level
+    halfrows = int(nrows/2.)
+    # Calculate size of each offset
+    dith_size_x = 0.95*maxDither*2.0/float(nrows)
+    dith_size_y = 0.95*np.sqrt(3)*maxDither/float(nrows)  #sqrt 3 comes from hexagon
+    # Calculate the row identification number, going from 0 at center
+    nid_row = np.arange(-halfrows, halfrows+1, 1)
+    # and the number of vertices in each row.
+    vert_in_row = (nrows+1) - np.abs(nid_row)
+    # Calculate offsets over hexagonal grid, row by row.
+    row = np.repeat(np.arange(nrows+1), vert_in_row)
+    j = np.arange(len(row)) - np.repeat(np.cumsum(vert_in_row) - vert_in_row, vert_in_row)
+    return dith_size_x * (j - (vert_in_row[row]-1)/2.0), dith_size_y * nid_row[row]
+
+def _pentagonOffsets(maxDither):
+    # inner pentagon tuples
+    nside= 5
+    inner= polygonCoords(nside, maxDither/2.5, 0.0)
+    # outer pentagon tuples
+    outerTemp= polygonCoords(nside, maxDither/1.3, np.pi)
+    # reorder outer tuples' order
+    outer= outerTemp[2:5] + outerTemp[0:2]
+    # join inner and outer coordiantes' array
+    return np.concatenate((zip(*inner)[0],zip(*outer)[0]), axis=0), \
+           np.concatenate((zip(*inner)[1],zip(*outer)[1]), axis=0)
+
+def _pentagonDiamondOffsets(maxDither):
+    # outer pentagon tuples
+    pentCoord= polygonCoords(5,maxDither/1.3, 0)
+    # inner diamond tuples
+    diamondCoord= polygonCoords(4, maxDither/2.5, np.pi/2)
+    # join inner and outer coordiantes' array + a point in the middle (origin)
+    return np.concatenate(([0],zip(*diamondCoord)[0],zip(*pentCoord)[0]), axis=0), \
+           np.concatenate(([0],zip(*diamondCoord)[1],zip(*pentCoord)[1]), axis=0)
+
+def ditherOffsets(pattern, maxDither, numPoints=None, nCoils=None):
+    """
+    Return the (xOff, yOff) offsets (radians) of a deterministic dither pattern.
+
+    pattern: one of 'spiral', 'hex', 'pentagon' or 'pentagonDiamond'
+    maxDither: the maximum dither (radians)
+    numPoints, nCoils: number of points and coils of the spiral (only used by the spiral)
+
+    The offsets are computed once per set of parameters and then shared, so the arrays are read-only.
+    """
+    if pattern != 'spiral':
+        numPoints, nCoils = None, None
+    key = (pattern, maxDither, numPoints, nCoils)
+    if key not in _offsetCache:
+        if pattern == 'spiral':
+            xOff, yOff = _spiralOffsets(maxDither, numPoints, nCoils)
+        elif pattern == 'hex':
+            xOff, yOff = _hexOffsets(maxDither)
+        elif pattern == 'pentagon':
+            xOff, yOff = _pentagonOffsets(maxDither)
+        elif pattern == 'pentagonDiamond':
+            xOff, yOff = _pentagonDiamondOffsets(maxDither)
+        else:
+            raise ValueError('Unknown dither pattern %s' %(pattern))
+        xOff.flags.writeable = False
+        yOff.flags.writeable = False
+        _offsetCache[key] = (xOff, yOff)
+    return _offsetCache[key]
+
+def randomHexOffsets(noffsets, maxDither):
+    """
+    Return noffsets (xOff, yOff) offsets (radians) drawn uniformly within the hexagon inscribed in
+    a circle of radius maxDither.
+    """
+    # Sample the hexagon exactly: split it into six equilateral triangles of equal area (the center plus
+    # two adjacent vertices), pick a triangle for each offset, and then a uniform point inside it.
+    vertexAngles= np.arange(7)*np.pi/3.0
+    xVertex= maxDither*np.cos(vertexAngles)
+    yVertex= maxDither*np.sin(vertexAngles)
+    triangle= np.random.randint(0, 6, noffsets)
+
+    u= np.random.rand(noffsets)
+    v= np.random.rand(noffsets)
+    # points in the far half of the parallelogram spanned by the two vertices are reflected back
+    # into the triangle.
+    outside= (u+v > 1.0)
+    u[outside]= 1.0-u[outside]
+    v[outside]= 1.0-v[outside]
+
+    return u*xVertex[triangle] + v*xVertex[triangle+1], u*yVertex[triangle] + v*yVertex[triangle+1]
+
+def repulsiveRandomHexOffsets(noffsets, maxDither):
+    """
+    Return noffsets (xOff, yOff) offsets (radians) drawn repulsive-randomly within the hexagon inscribed in
+    a circle of radius maxDither.
+    """
+    # Strategy: Tile the circumscribing square with squares. Discard those that fall outside the hexagon.
+    # Then choose squares repulsive-randomly, and choose a random point from each chosen square.
+
+    squareSide= maxDither*2   # circumscribing square. center at (0,0)
+    # number of tiles along each side (the total number of tiles is a perfect square). the hexagon covers
+    # ~65% of the square, so make sure there are always enough tiles inside it for large noffsets.
+    tilesPerSide= max(int(np.ceil(np.sqrt(noffsets)))+170, int(np.ceil(np.sqrt(noffsets/0.6))))
+    tileSide= squareSide/tilesPerSide
+
+    # x/y-coords of the tiles' centers: rows go from the top down, tiles in a row go from left to right.
+    centers= (np.arange(tilesPerSide)-(tilesPerSide-1)/2.0)*tileSide
+    xCenter, yCenter= np.meshgrid(centers, centers[::-1])
+    xCenter= xCenter.ravel()
+    yCenter= yCenter.ravel()
+
+    # set up the hexagon
+    b= np.sqrt(3.0)*maxDither
+    m= np.sqrt(3.0)
+    h= maxDither*np.sqrt(3.0)/2.0
+
+    # find the points that are inside hexagon
+    insideHex= np.where((yCenter <= m*xCenter+b) &
+                        (yCenter >= m*xCenter-b) &
+                        (yCenter <= -m*xCenter+b) &
+                        (yCenter >= -m*xCenter-b) &
+                        (yCenter <= h) &
+                        (yCenter >= -h))[0]
+
+    if (len(insideHex) < noffsets):
+        raise ValueError('Need %d offsets but only %d tiling squares are inside the hexagon. '
+                         'Must increase the number of tiling squares.' %(noffsets, len(insideHex)))
+
+    # randomly select squares without replacement (the repulsion effect): equivalent to picking a random
+    # remaining square and deleting it, one offset at a time.
+    chosen= insideHex[np.random.permutation(len(insideHex))[0:noffsets]]
+    # assign a random offset from within each chosen square.
+    return xCenter[chosen] + (np.random.rand(noffsets)-0.5)*tileSide, \
+           yCenter[chosen] + (np.random.rand(noffsets)-0.5)*tileSide
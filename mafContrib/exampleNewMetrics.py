@@ -3,30 +3,179 @@
 
 from lsst.sims.maf.metrics import BaseMetric
 import numpy as np
+from .nightSummaryStacker import filterBitCounts
+from .batchSlices import sliceIds, groupStarts
 
     
 class NightsWithNFiltersMetric(BaseMetric):
     """
     Count how many times more than NFilters are used within the same night, for this set of visits.
     """
-    def __init__(self, nightCol='night', filterCol='filter', nFilters=3, **kwargs):
+    def __init__(self, nightCol='night', filterCol='filter', nFilters=3, nightSummary=None,
+                 nightSummaryIdCol='nightSummaryId', filterCodeCol=None, **kwargs):
         """
         nightCol = the name of the column defining the night
         filterCol = the name of the column defining the filter
         nFilters = the minimum desired set of filters used in these visits
+        nightSummary = optionally, a NightSummaryStacker: the metric then works on its per-night
+                       summary of the visits, found through the nightSummaryIdCol column
+                       (field-based slicers only, see NightSummaryStacker)
+        filterCodeCol = optionally, the filter code column added by FilterCodeStacker, to be used
+                        instead of the filter names
         """
         self.nightCol = nightCol
         self.filterCol = filterCol
         self.nFilters = nFilters
-        super(NightsWithNFiltersMetric, self).__init__(col=[self.nightCol, self.filterCol],
-                                                       **kwargs)
+        self.nightSummary = nightSummary
+        self.nightSummaryIdCol = nightSummaryIdCol
+        self.filterCodeCol = filterCodeCol
+        if self.nightSummary is not None:
+            cols = [self.nightSummaryIdCol]
+        elif self.filterCodeCol is not None:
+            cols = [self.nightCol, self.filterCodeCol]
+        else:
+            cols = [self.nightCol, self.filterCol]
+        super(NightsWithNFiltersMetric, self).__init__(col=cols, **kwargs)
 
     def run(self, dataSlice, slicePoint=None):
-        count = 0
-        uniqueNights = np.unique(dataSlice[self.nightCol])
-        for n in uniqueNights:
-            condition = (dataSlice[self.nightCol] == n)
-            uniqueFilters = np.unique(dataSlice[self.filterCol][condition])
-            if len(uniqueFilters) > self.nFilters:
-                count += 1
-        return count    
+        return np.sum(self._filtersPerNight(dataSlice) > self.nFilters)
+
+    def runBatch(self, dataSlices, offsets):
+        """
+        Return the metric values of many slices at once: slice i is dataSlices[offsets[i]:offsets[i+1]].
+        """
+        nightSlices, nFiltersPerNight = self._filtersPerNightBatch(dataSlices, offsets)
+        return np.bincount(nightSlices, weights=(nFiltersPerNight > self.nFilters),
+                           minlength=len(offsets)-1).astype(int)
+
+    def _filtersPerNightBatch(self, dataSlices, offsets):
+        """
+        Return the slice of each (slice, night) of the concatenated dataSlices, and the number of distinct
+        filters used in it.
+        """
+        if len(dataSlices) == 0:
+            # Every slice is empty: no nights, so runBatch gives 0 (or a zero histogram) for each.
+            return np.zeros(0, int), np.zeros(0, int)
+        slices = sliceIds(offsets)
+        if self.nightSummary is not None:
+            # Find the summary rows of each slice, then combine the filters of each night as in run().
+            ids = dataSlices[self.nightSummaryIdCol]
+            order = np.lexsort((ids, slices))
+            ids = ids[order]
+            slices = slices[order]
+            newRow = groupStarts(slices, ids)
+            rows = self.nightSummary.summary[ids[newRow]]
+            self.nightSummary.checkWholeRows(rows, np.diff(np.append(np.where(newRow)[0], len(ids))))
+            slices = slices[newRow]
+            order = np.lexsort((rows['night'], slices))
+            nights = rows['night'][order]
+            slices = slices[order]
+            nightStart = np.where(groupStarts(slices, nights))[0]
+            filterMasks = np.bitwise_or.reduceat(rows['filterMask'][order], nightStart)
+            return slices[nightStart], filterBitCounts[filterMasks]
+        # Sort by slice, night and filter (or filter code) once, keep the unique (slice, night, filter)
+        # and count them per (slice, night).
+        if self.filterCodeCol is not None:
+            filters = dataSlices[self.filterCodeCol]
+        else:
+            filters = dataSlices[self.filterCol]
+        order = np.lexsort((filters, dataSlices[self.nightCol], slices))
+        nights = dataSlices[self.nightCol][order]
+        filters = filters[order]
+        slices = slices[order]
+        newNight = groupStarts(slices, nights)
+        newTriple = newNight | groupStarts(filters)
+        nightId = np.cumsum(newNight) - 1
+        return slices[newNight], np.bincount(nightId[newTriple], minlength=np.sum(newNight))
+
+    def _filtersPerNight(self, dataSlice):
+        """
+        Return the number of distinct filters used on each night of dataSlice.
+        """
+        if len(dataSlice) == 0:
+            return np.zeros(0, int)
+        if self.nightSummary is not None:
+            return self._filtersPerNightSummary(dataSlice)
+        if self.filterCodeCol is not None:
+            return self._filtersPerNightCodes(dataSlice)
+        # Sort by night and filter once, keep the unique (night, filter) pairs and count them per night.
+        order = np.lexsort((dataSlice[self.filterCol], dataSlice[self.nightCol]))
+        nights = dataSlice[self.nightCol][order]
+        filters = dataSlice[self.filterCol][order]
+        newNight = groupStarts(nights)
+        newPair = newNight | groupStarts(filters)
+        nightId = np.cumsum(newNight) - 1
+        return np.bincount(nightId[newPair])
+
+    def _filtersPerNightSummary(self, dataSlice):
+        # Combine the filters used on each night (over all the fields in this slice), and count them.
+        rows = self.nightSummary.sliceRows(dataSlice[self.nightSummaryIdCol])
+        order = np.argsort(rows['night'], kind='mergesort')
+        nights = rows['night'][order]
+        nightStart = np.where(groupStarts(nights))[0]
+        filterMasks = np.bitwise_or.reduceat(rows['filterMask'][order], nightStart)
+        return filterBitCounts[filterMasks]
+
+    def _filtersPerNightCodes(self, dataSlice):
+        # Turn each filter code into a bit, OR the bits over each night, and count the bits set.
+        order = np.argsort(dataSlice[self.nightCol], kind='mergesort')
+        nights = dataSlice[self.nightCol][order]
+        nightStart = np.where(groupStarts(nights))[0]
+        filterBits = np.left_shift(1, dataSlice[self.filterCodeCol][order].astype(np.uint8))
+        filterMasks = np.bitwise_or.reduceat(filterBits, nightStart)
+        return filterBitCounts[filterMasks]
+
+
+class NightsWithNFiltersHistMetric(NightsWithNFiltersMetric):
+    """
+    Histogram the nights by the number of distinct filters used within them, for this set of visits.
+
+    The metric value is an array whose n-th entry is the number of nights with exactly n filters, so the
+    number of nights with more than any nFilters can be read off one run (see nightsWithMoreThan and the
+    reduce methods), instead of running one NightsWithNFiltersMetric per threshold.
+    """
+    def __init__(self, nightCol='night', filterCol='filter', maxFilters=6, metricName='NightsWithNFiltersHist',
+                 **kwargs):
+        """
+        maxFilters = the histogram covers 0 to maxFilters filters per night (more are counted as maxFilters)
+        Other arguments as for NightsWithNFiltersMetric.
+        """
+        self.maxFilters = maxFilters
+        super(NightsWithNFiltersHistMetric, self).__init__(nightCol=nightCol, filterCol=filterCol,
+                                                           metricName=metricName, metricDtype='object',
+                                                           **kwargs)
+
+    def run(self, dataSlice, slicePoint=None):
+        nFiltersPerNight = np.minimum(self._filtersPerNight(dataSlice), self.maxFilters)
+        return np.bincount(nFiltersPerNight, minlength=self.maxFilters+1)
+
+    def runBatch(self, dataSlices, offsets):
+        """
+        Return the histograms of many slices at once (one row per slice): slice i is
+        dataSlices[offsets[i]:offsets[i+1]].
+        """
+        nightSlices, nFiltersPerNight = self._filtersPerNightBatch(dataSlices, offsets)
+        nBins = self.maxFilters+1
+        bins = nightSlices*nBins + np.minimum(nFiltersPerNight, self.maxFilters)
+        return np.bincount(bins, minlength=(len(offsets)-1)*nBins).reshape(len(offsets)-1, nBins)
+
+    def nightsWithMoreThan(self, metricValue, nFilters):
+        """
+        Return the number of nights with more than nFilters filters, from the histogram metricValue.
+        """
+        return np.sum(metricValue[nFilters+1:])
+
+    def reduceMoreThan1(self, metricValue):
+        return self.nightsWithMoreThan(metricValue, 1)
+
+    def reduceMoreThan2(self, metricValue):
+        return self.nightsWithMoreThan(metricValue, 2)
+
+    def reduceMoreThan3(self, metricValue):
+        return self.nightsWithMoreThan(metricValue, 3)
+
+    def reduceMoreThan4(self, metricValue):
+        return self.nightsWithMoreThan(metricValue, 4)
+
+    def reduceMoreThan5(self, metricValue):
+        return self.nightsWithMoreThan(metricValue, 5)
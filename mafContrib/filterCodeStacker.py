@@ -0,0 +1,36 @@
+import numpy as np
+from lsst.sims.maf.stackers import BaseStacker
+
+__all__ = ['FilterCodeStacker', 'filterCodes']
+
+def filterCodes(filters, filterNames='ugrizy'):
+    """
+    Translate an array of filter names into small integer codes: the i-th filter of filterNames gets
+    code i, and any other filter gets code len(filterNames).
+    """
+    codes = np.zeros(len(filters), np.uint8) + len(filterNames)
+    for i, f in enumerate(filterNames):
+        codes[filters == f] = i
+    return codes
+
+class FilterCodeStacker(BaseStacker):
+    """
+    Add a uint8 filter code column (0-5 for 'ugrizy', 6 for anything else), so that metrics can use
+    bincounts, bitmasks and lookup tables instead of comparing the filter strings for every slice.
+    """
+    def __init__(self, filterCol='filter', filterNames='ugrizy'):
+        self.filterCol = filterCol
+        self.filterNames = filterNames
+        # Names of columns we want to add.
+        self.colsAdded = ['filterCode']
+        self.colsAddedDtypes = [np.uint8]
+        # Names of columns we need from database.
+        self.colsReq = [filterCol]
+        # List of units for our new columns.
+        self.units = ['']
+
+    def run(self, simData):
+        # Add new columns to simData.
+        simData = self._addStackers(simData)
+        simData['filterCode'] = filterCodes(simData[self.filterCol], self.filterNames)
+        return simData
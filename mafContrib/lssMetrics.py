@@ -2,23 +2,41 @@ import numpy as np
 import healpy as hp
 import scipy
 
-from lsst.sims.maf.metrics import BaseMetric, Coaddm5Metric
+from lsst.sims.maf.metrics import BaseMetric
+from .slicePointCache import CachedCoaddm5Metric
 
+# Tables of the galaxy count integral, keyed by (minimum coadded depth, maximum coadded depth, rtol),
+# shared by all the GalaxyCountsMetric instances.
+_galCountTables = {}
 
 class GalaxyCountsMetric(BaseMetric):
     """
     Estimate the number of galaxies expected at a particular coadded depth.
     """
-    def __init__(self, m5Col = 'fiveSigmaDepth', nside=128, metricName='GalaxyCounts', **kwargs):
+    def __init__(self, m5Col = 'fiveSigmaDepth', nside=128, metricName='GalaxyCounts',
+                 lookupTable=True, tableRange=(15., 35.), tableRtol=1e-6, slicePointCache=None, slicerKey=None,
+                 constraint=None, **kwargs):
+        """
+        lookupTable: If True, interpolate the galaxy count integral in a table of coadded depths computed once,
+        instead of integrating it at every slicepoint. Coadded depths outside tableRange are still integrated.
+        tableRange: The range of coadded depths covered by the table.
+        tableRtol: The largest relative error of the interpolation, checked halfway through each table step.
+        slicePointCache: Optionally, a SlicePointCache to share the coadded depth with other metrics in,
+        together with the slicerKey and sql constraint of the bundle (both required with a cache).
+        """
         self.m5Col = m5Col
         super(GalaxyCountsMetric, self).__init__(col=self.m5Col, metricName=metricName, **kwargs)
         # Use the coadded depth metric to calculate the coadded depth at each point.
-        self.coaddmetric = Coaddm5Metric(m5Col=self.m5Col)
+        self.coaddmetric = CachedCoaddm5Metric(m5Col=self.m5Col, slicePointCache=slicePointCache,
+                                               slicerKey=slicerKey, constraint=constraint)
         # Total of 41253.0 galaxies across the sky (at what magnitude?).
         # This didn't seem to work quite right for me..
         self.scale = 41253.0 / hp.nside2npix(nside) / 5000.
         # Reset units (otherwise uses magnitudes).
         self.units = 'Galaxy Counts'
+        self.lookupTable = lookupTable
+        if self.lookupTable:
+            self.tableCoaddm5, self.tableLogCounts = self._galCountTable(tableRange, tableRtol)
 
     def _galCount(self, apparent_mag, coaddm5):
         # Order for galCount must be apparent mag, then coaddm5, for scipy.integrate method.
@@ -26,13 +44,53 @@ class GalaxyCountsMetric(BaseMetric):
         completeness = 0.5*scipy.special.erfc(apparent_mag-coaddm5)
         return dn_gal*completeness
 
+    def _galCountIntegral(self, coaddm5):
+        # From Carroll et al, 2014 SPIE (http://arxiv.org/abs/1501.04733)
+        num_gal, intErr = scipy.integrate.quad(self._galCount, -np.inf, 32, args=coaddm5)
+        return num_gal
+
+    def _galCountTable(self, tableRange, rtol):
+        key = (tableRange[0], tableRange[1], rtol)
+        if key not in _galCountTables:
+            # The integral goes as 10**(0.34*coaddm5) (until coaddm5 nears the upper limit), so interpolate
+            # its log. Start with 0.1 mag steps, and split the steps where the interpolation halfway through
+            # is not within rtol of the integral, until none is left.
+            nSteps = int(round((tableRange[1]-tableRange[0])/0.1))
+            coaddm5 = np.linspace(tableRange[0], tableRange[1], nSteps+1)
+            logCounts = np.log([self._galCountIntegral(m) for m in coaddm5])
+            toCheck = np.arange(len(coaddm5)-1)
+            while len(toCheck) > 0:
+                midCoaddm5 = 0.5*(coaddm5[toCheck] + coaddm5[toCheck+1])
+                midLogCounts = np.log([self._galCountIntegral(m) for m in midCoaddm5])
+                err = np.abs(np.expm1(np.interp(midCoaddm5, coaddm5, logCounts) - midLogCounts))
+                # Keep all the midpoints in the table; both halves of the failed steps are checked next.
+                coaddm5 = np.insert(coaddm5, toCheck+1, midCoaddm5)
+                logCounts = np.insert(logCounts, toCheck+1, midLogCounts)
+                failed = (toCheck + np.arange(len(toCheck)))[err > rtol]
+                toCheck = np.sort(np.concatenate((failed, failed+1)))
+            _galCountTables[key] = (coaddm5, logCounts)
+        return _galCountTables[key]
+
+    def galaxyCounts(self, coaddm5):
+        """
+        Return the number of galaxies expected at each of the coadded depths coaddm5 (e.g. a whole map).
+        """
+        coaddm5 = np.asarray(coaddm5, dtype=float)
+        flatCoaddm5 = coaddm5.ravel()
+        if self.lookupTable:
+            num_gal = np.exp(np.interp(flatCoaddm5, self.tableCoaddm5, self.tableLogCounts))
+            outside = ~((flatCoaddm5 >= self.tableCoaddm5[0]) & (flatCoaddm5 <= self.tableCoaddm5[-1]))
+        else:
+            num_gal = np.zeros(len(flatCoaddm5))
+            outside = np.ones(len(flatCoaddm5), bool)
+        num_gal[outside] = [self._galCountIntegral(m) for m in flatCoaddm5[outside]]
+        return (num_gal*self.scale).reshape(coaddm5.shape)
+
     def run(self, dataSlice, slicePoint=None):
         # Calculate the coadded depth.
-        coaddm5 = self.coaddmetric.run(dataSlice)
+        coaddm5 = self.coaddmetric.run(dataSlice, slicePoint)
         # Calculate the number of galaxies.
         # From Carroll et al, 2014 SPIE (http://arxiv.org/abs/1501.04733)
         # I'm not entirely certain this gives a properly calibrated number of galaxy counts,
         # however it is proportional to the expected number at least (and should be within an order of magnitude)
-        num_gal, intErr = scipy.integrate.quad(self._galCount, -np.inf, 32, args=coaddm5)
-        num_gal *= self.scale
-        return num_gal
+        return float(self.galaxyCounts(coaddm5))
@@ -11,14 +11,108 @@ import numpy as np
 import os
 import healpy as hp
 import copy
+import multiprocessing
 import lsst.sims.maf.plots as plots
 
+# neighbour tables already computed, keyed by nside.
+_neighbourTables= {}
+
+def healpixNeighbourTable(nside, cacheDir= None):
+    """
+    Return the (8, npix) int32 array of the neighbours of every HEALpix pixel (-1 for inexistent neighbors).
+
+    The table is computed once per nside with a single hp.get_all_neighbours call and kept in memory.
+    If cacheDir is given, it is also saved there as a .npy file, which later runs memory-map instead
+    of recomputing it.
+    """
+    if nside not in _neighbourTables:
+        filename= None
+        if cacheDir is not None:
+            filename= os.path.join(cacheDir, 'healpixNeighbours_nside%d.npy' %(nside))
+        if (filename is not None) and os.path.exists(filename):
+            table= np.load(filename, mmap_mode= 'r')
+            if table.dtype != np.int32:
+                # a table saved before they were stored as int32.
+                table= table.astype(np.int32)
+        else:
+            # pixel numbers fit in int32 up to nside 8192: half the memory (and file) of hp's int64.
+            table= hp.get_all_neighbours(nside, np.arange(hp.nside2npix(nside))).astype(np.int32)
+            if filename is not None:
+                np.save(filename, table)
+        _neighbourTables[nside]= table
+    return _neighbourTables[nside]
+
+def _relationMasks(array, relation, value):
+    """
+    Return the boolean arrays of the pixels that satisfy (array relation value) and of those that
+    satisfy its complement, as used for the border test.
+    """
+    if (relation == '<'):
+        return (array < value), (array >= value)
+    if (relation == '='):
+        return (array == value), (array != value)
+    if (relation == '>'):
+        return (array > value), (array <= value)
+    raise ValueError('Invalid relation: %s. Must be "<", "=" or ">".' %(relation))
+
+def findBorderPixels(array, relation, value, neighbours, candidates= None):
+    """
+    Return the (sorted) pixels that satisfy (array relation value) and have at least one neighbor
+    that does not. neighbours is the neighbour table from healpixNeighbourTable. If candidates (a sorted
+    array of pixels) is given, only those pixels are tested.
+    """
+    if candidates is None:
+        inside, outside= _relationMasks(array, relation, value)
+        # -1 entries correspond to inexistent neighbors
+        outsideNeighbour= outside[neighbours] & (neighbours != -1)
+        return np.where(inside & np.any(outsideNeighbour, axis= 0))[0]
+    candidateNeighbours= neighbours[:, candidates]
+    inside= _relationMasks(array[candidates], relation, value)[0]
+    outsideNeighbour= _relationMasks(array[candidateNeighbours], relation, value)[1] & (candidateNeighbours != -1)
+    return candidates[inside & np.any(outsideNeighbour, axis= 0)]
+
+def borderErosion(array, relation, value, newValue, neighbours, pixelRadius):
+    """
+    Generate the border pixels found in each of pixelRadius rounds: the first round finds the pixels with
+    (array relation value) and a neighbor without; each later round first assigns newValue to the previous
+    border (array is modified in place) and then finds the new border.
+
+    Only the previous border and its neighbors can change border status when the previous border is
+    reassigned, so after the first round only those are tested: the cost follows the length of the border
+    rather than the number of pixels.
+    """
+    if (pixelRadius < 1):
+        return
+    borderPixel= findBorderPixels(array, relation, value, neighbours)
+    yield borderPixel
+    for r in range(1, pixelRadius):
+        array[borderPixel]= newValue
+        candidates= np.unique(np.concatenate((borderPixel, neighbours[:, borderPixel].ravel())))
+        candidates= candidates[candidates != -1]
+        borderPixel= findBorderPixels(array, relation, value, neighbours, candidates)
+        yield borderPixel
+
+def _borderRounds(args):
+    # the border pixels of every round for one dither (run in the worker processes when in parallel).
+    origArray, relation, value, newValue, nside, neighbourCacheDir, pixelRadius= args
+    neighbours= healpixNeighbourTable(nside, neighbourCacheDir)
+    return list(borderErosion(origArray, relation, value, newValue, neighbours, pixelRadius))
+
+def _applyBorders(metricValues, totalBorderPixel, newValueToAssign, newValueIsMask):
+    # change the map/array in place.
+    if newValueIsMask:
+        metricValues.mask[totalBorderPixel]= newValueToAssign
+        metricValues.data[totalBorderPixel]= 0.0
+    else:
+        metricValues.data[totalBorderPixel]= newValueToAssign
+
 def maskingAlgorithmGeneralized(myBundles, plotHandler, dataLabel, nside= 128,
                                 findValue= 'unmasked', relation= '=',
                                 newValue= 'masked',
                                 pixelRadius= 6, returnBorderIndices= False,
                                 printInfo= True, plotIntermediatePlots= True,
-                                skyMapColorMin= -0.12, skyMapColorMax= 0.12):
+                                skyMapColorMin= -0.12, skyMapColorMax= 0.12, neighbourCacheDir= None,
+                                headless= False, nProcesses= 1):
     """
     Assign newValue to all pixels in a skymap within pixelRadius of pixels with value <, >, or = findValue.
 
@@ -38,6 +132,12 @@ def maskingAlgorithmGeneralized(myBundles, plotHandler, dataLabel, nside= 128,
       * plotIntermediatePlots - set to False if do not want to plot intermediate plots. default: True
       * skyMapColorMin - colorMin label value for skymap plotDict label. default: -0.12
       * skyMapColorMax - colorMax label value for skymap plotDict label. default: 0.12
+      * neighbourCacheDir - directory to cache the HEALpix neighbour table in. default: None (no disk cache)
+      * headless - set to True to skip all copies of the bundles and all plots, and change the arrays in place.
+                   myBundles may then also be a dictionary of masked arrays, and [borders, arrays] is returned,
+                   with borders the dictionary of border indices and arrays that of the changed masked arrays.
+                   default: False
+      * nProcesses - number of processes to find the borders of the different dithers in. default: 1
 
     """
     # find pixels such that (pixelValue (relation) findValue) AND their neighbors dont have that (relation) findValue.
@@ -70,46 +170,42 @@ def maskingAlgorithmGeneralized(myBundles, plotHandler, dataLabel, nside= 128,
         if (newValue == 'unmasked'):
             newValueToAssign= False
 
+    if relation not in ['<', '=', '>']:
+        raise ValueError('Invalid relation: %s. Must be "<", "=" or ">".' %(relation))
+    # compute the neighbour table here once, so that worker processes inherit it.
+    healpixNeighbourTable(nside, neighbourCacheDir)
+
     borders= {}
-    
-    for dither in myBundles:
-        totalBorderPixel= []
+    dithers= list(myBundles)
 
-        # find the appropriate array to look at.
+    # find the appropriate array to look at for each dither: one copy, eroded in place.
+    origArrays= []
+    for dither in dithers:
+        metricValues= getattr(myBundles[dither], 'metricValues', myBundles[dither])
         if (str(findValue)).__contains__('mask'):
-            origArray= myBundles[dither].metricValues.mask.copy()    # mask array
+            origArrays.append(metricValues.mask.copy())    # mask array
         else:
-            origArray= myBundles[dither].metricValues.data.copy()    # data array
-            
-        for r in range(0,pixelRadius):
-            borderPixel= []
-            tempCopy= copy.deepcopy(myBundles)
-            
-            # ignore the pixels whose neighbors formed the border in previous run
-            if (r != 0):
-                origArray[totalBorderPixel]= newValueToAssign
-
-            # find the pixels that satisfy the relation with findValue and whose neighbors dont
-            for i in range(0, len(origArray)):
-                neighborsPixels= hp.get_all_neighbours(nside,i)   # i is the pixel number
-                for j in neighborsPixels:
-                    condition= None
-                    if (relation == '<'):
-                        condition= ((origArray[i] < findValueToConsider) & (origArray[j] >= findValueToConsider))
-                    if (relation == '='):
-                        condition= ((origArray[i] == findValueToConsider) & (origArray[j] != findValueToConsider))
-                    if (relation == '>'):
-                        condition= ((origArray[i] > findValueToConsider) & (origArray[j] <= findValueToConsider))
-                    if (condition == None):
-                        print 'ERROR: invalid relation: ', relation
-                        print 'Aborting.'
-                        stop
-                        
-                    if condition:
-                        if (j != -1):                            # -1 entries correspond to inexistent neighbors
-                            borderPixel.append(i)
-        
-            borderPixel= np.unique(borderPixel)
+            origArrays.append(metricValues.data.copy())    # data array
+
+    # find the pixels that satisfy the relation with findValue and whose neighbors dont, ignoring
+    # the pixels whose neighbors formed the border in previous runs. the dithers are independent, so
+    # they can be done in parallel: only the arrays go to the workers, and the results come back in order.
+    erosionArgs= [(origArray, relation, findValueToConsider, newValueToAssign, nside, neighbourCacheDir,
+                   pixelRadius) for origArray in origArrays]
+    if (nProcesses > 1) and (len(dithers) > 1):
+        pool= multiprocessing.Pool(min(nProcesses, len(dithers)))
+        try:
+            ditherRounds= pool.map(_borderRounds, erosionArgs, chunksize= 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        ditherRounds= [_borderRounds(args) for args in erosionArgs]
+
+    for dither, rounds in zip(dithers, ditherRounds):
+        totalBorderPixel= []
+
+        for r, borderPixel in enumerate(rounds):
             totalBorderPixel.extend(borderPixel)
 
             if printInfo:
@@ -118,7 +214,8 @@ def maskingAlgorithmGeneralized(myBundles, plotHandler, dataLabel, nside= 128,
                 print ''
       
             # plot found pixels
-            if plotIntermediatePlots:
+            if plotIntermediatePlots and not headless:
+                tempCopy= copy.deepcopy(myBundles)
                 if (str(newValue)).__contains__('mask'):
                     tempCopy[dither].metricValues.mask[:]= newValueToAssign
                     tempCopy[dither].metricValues.mask[totalBorderPixel]= not(newValueToAssign)
@@ -138,15 +235,18 @@ def maskingAlgorithmGeneralized(myBundles, plotHandler, dataLabel, nside= 128,
             
             borders[dither]= totalBorderPixel   # save the found pixels with the appropriate key
 
+    if headless:
+        maskedArrays= {}
+        for dither in dithers:
+            maskedArrays[dither]= getattr(myBundles[dither], 'metricValues', myBundles[dither])
+            _applyBorders(maskedArrays[dither], borders[dither], newValueToAssign,
+                          (str(newValue)).__contains__('mask'))
+        return [borders, maskedArrays]
+
     # change the original map/array.
     for dither in myBundles:
-        totalBorderPixel= borders[dither]
-        
-        if (str(newValue)).__contains__('mask'):
-            myBundles[dither].metricValues.mask[totalBorderPixel]= newValueToAssign
-            myBundles[dither].metricValues.data[totalBorderPixel]= 0.0
-        else:
-            myBundles[dither].metricValues.data[totalBorderPixel]= newValueToAssign
+        _applyBorders(myBundles[dither].metricValues, borders[dither], newValueToAssign,
+                      (str(newValue)).__contains__('mask'))
             
         plotDict = {'xlabel':dataLabel, 'title':'%s: %s MaskedMap; pixelRadius: %s ' %(dither,dataLabel, pixelRadius), 
                     'logScale': False, 'labelsize': 8,'colorMin': skyMapColorMin, 'colorMax': skyMapColorMax}
@@ -4,6 +4,7 @@
 
 from lsst.sims.maf.metrics import BaseMetric
 import numpy as np
+from .batchSlices import seasonStatistics
 
 
 class MeanNightSeparationMetric(BaseMetric):
@@ -20,46 +21,41 @@ class MeanNightSeparationMetric(BaseMetric):
     
     Used by: LensedQuasarTimeDelays, ...
     """
-    def __init__(self, seasonCol='season', nightCol='night', **kwargs):
+    def __init__(self, seasonCol='season', nightCol='night', nightSummary=None,
+                 nightSummaryIdCol='nightSummaryId', **kwargs):
         """
         seasonCol = the name of the column defining the season number
         nightCol = the name of the column defining the visit night
+        nightSummary = optionally, a NightSummaryStacker: the metric then works on its per-night
+                       summary of the visits, found through the nightSummaryIdCol column
+                       (field-based slicers only, see NightSummaryStacker)
         """
         self.seasonCol = seasonCol
         self.nightCol = nightCol
-        super(MeanNightSeparationMetric, self).__init__(col=[self.seasonCol, self.nightCol], **kwargs)
+        self.nightSummary = nightSummary
+        self.nightSummaryIdCol = nightSummaryIdCol
+        if self.nightSummary is None:
+            cols = [self.seasonCol, self.nightCol]
+        else:
+            cols = [self.nightSummaryIdCol]
+        super(MeanNightSeparationMetric, self).__init__(col=cols, **kwargs)
 
     def run(self, dataSlice, slicePoint=None):
-        # Small loop over the seasons:
-        uniqSeasons = np.unique(dataSlice[self.seasonCol])
-        seasonMeans = np.array([])
-        for k in uniqSeasons:
-            # Extract this season's nights:
-            condition = (dataSlice[self.seasonCol] == k)
-            # Find unique nights, and sort:
-            nights = np.atleast_1d(np.sort(np.unique(dataSlice[self.nightCol][condition])))
-            # Check the number of observing nights this season:
-            # print "season, nights: ",k,nights
-            if len(nights) == 0:
-                # print "    zero nights, continuing..."
-                continue
-            elif len(nights) == 1:
-                # print "    one night, setting this season's mean to 0.0"
-                thisSeasonMean = 0.0
-            else:
-                # Offset and subtract to get array of separations, then average.
-                # Note zero-padding at the end to make it the same length as the nights array:
-                nextnights =  np.append(nights[1:],0)
-                thisSeasonMean = np.average(np.atleast_1d(nextnights - nights)[:-1])
-                # print "    more than one night, mean separation = ",thisSeasonMean
-            seasonMeans = np.append(seasonMeans,thisSeasonMean)
-        # Take average over seasons, defensively:
-        # print "taking average over the following seasons' mean separations:",seasonMeans
-        if len(seasonMeans > 0):
-            campaignMean = np.average(seasonMeans)
+        if len(dataSlice) == 0:
+            return 0.0
+        if self.nightSummary is None:
+            seasons = dataSlice[self.seasonCol]
+            nights = dataSlice[self.nightCol]
         else:
-            campaignMean = 0.0
-        # print "result =",campaignMean
+            # Use the (field, night, season) summary rows of these visits instead of the visits themselves.
+            rows = self.nightSummary.sliceRows(dataSlice[self.nightSummaryIdCol])
+            seasons = rows['season']
+            nights = rows['night']
+        # The mean separation between consecutive observing nights within each season
+        # (0.0 for a season with only one night):
+        seasonSlices, lengths, seasonMeans = seasonStatistics(seasons, nights=nights)
+        # Take average over seasons:
+        campaignMean = np.average(seasonMeans)
         return campaignMean # in days
 
 # ======================================================================
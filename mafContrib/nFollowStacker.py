@@ -1,9 +1,40 @@
+import ctypes
+import multiprocessing
 import numpy as np
 from lsst.sims.maf.stackers import BaseStacker
 from lsst.sims.utils import altAzPaFromRaDec
 
 from .findTelescopes import findTelescopes
 
+# Number of bits set in each possible byte.
+_byteBitCounts = np.array([bin(i).count('1') for i in range(256)])
+
+def countBits(bitmask, selection=None):
+    """
+    Return the number of bits set in each element of the uint64 array bitmask, e.g. the followBitmask
+    column of NFollowStacker. If selection (a uint64 mask) is given, only its bits are counted.
+    """
+    bitmask = np.asarray(bitmask, dtype=np.uint64)
+    if selection is not None:
+        bitmask = np.bitwise_and(bitmask, np.uint64(selection))
+    bitmask = np.ascontiguousarray(bitmask)
+    return _byteBitCounts[bitmask.view(np.uint8)].reshape(bitmask.shape + (8,)).sum(axis=-1)
+
+# The stacker, inputs and shared outputs of the worker processes of NFollowStacker.run,
+# set once per process by _initWorker.
+_workerState = None
+
+def _initWorker(stacker, ra, dec, expMJD, nObservatories, followBitmask):
+    global _workerState
+    _workerState = (stacker, ra, dec, expMJD, np.frombuffer(nObservatories, np.int64),
+                    None if followBitmask is None else np.frombuffer(followBitmask, np.uint64))
+
+def _followChunk(chunk):
+    stacker, ra, dec, expMJD, nObservatories, followBitmask = _workerState
+    start, stop = chunk
+    stacker._follow(ra[start:stop], dec[start:stop], expMJD[start:stop], nObservatories[start:stop],
+                    None if followBitmask is None else followBitmask[start:stop])
+
 class NFollowStacker(BaseStacker):
     """
     Add the number of telescopes that could follow up any visit,
@@ -11,13 +42,20 @@ class NFollowStacker(BaseStacker):
     """
     def __init__(self, minSize=3.0, expMJDCol='expMJD',
                  raCol='fieldRA', decCol='fieldDec', airmassLimit=2.5,
-                 timeSteps=[0.,1.]):
+                 timeSteps=[0.,1.], bitmask=None,
+                 chunkSize=None, nProcesses=1):
         """
         minSize: The minimum telescope apperture to use
         airmassLimit: The maximum airmass a target can be at and stil be counted
         timeSteps: timeStep to use (hours).  The time steps to use. Default=[0,1], which means the object
         must be above the airmass limit at the time of the LSST visit, or one hour after, to be counted as
         followed up.
+        bitmask: If 'telescope' or 'site', also add a uint64 followBitmask column, with one bit per
+        telescope or per site (named in self.bitNames) set when it could follow up the visit. Counts for
+        any subset of telescopes can then be found later with countBits and selectionMask.
+        chunkSize: If set, compute the visits in blocks of chunkSize, which bounds the memory used.
+        nProcesses: The number of processes to compute the blocks in (default 1, no subprocesses).
+        The results do not depend on chunkSize or nProcesses.
         """
         self.expMJDCol = expMJDCol
         self.raCol = raCol
@@ -29,26 +67,122 @@ class NFollowStacker(BaseStacker):
         self.units = ['#']
         self.airmassLimit = airmassLimit
         self.timeSteps = timeSteps
+        self.chunkSize = chunkSize
+        self.nProcesses = nProcesses
 
         self.telescopes = findTelescopes(minSize = minSize)
+        # Several telescopes share a site (e.g. seven on Mauna Kea), and they all see the same sky:
+        # group them, so visibility is computed once per site, and keep each telescope's site and
+        # the number of telescopes at each site.
+        coords = np.zeros(len(self.telescopes), dtype=[('lat', float), ('lon', float)])
+        coords['lat'] = self.telescopes['lat']
+        coords['lon'] = self.telescopes['lon']
+        self.sites, self.telescopeSite, self.siteMultiplicity = np.unique(coords, return_inverse=True,
+                                                                          return_counts=True)
 
+        self.bitmask = bitmask
+        if self.bitmask is not None:
+            if self.bitmask == 'telescope':
+                self.bitNames = list(self.telescopes['name'])
+                telescopeBits = np.arange(len(self.telescopes))
+            elif self.bitmask == 'site':
+                self.bitNames = [', '.join(self.telescopes['name'][self.telescopeSite == i])
+                                 for i in range(len(self.sites))]
+                telescopeBits = self.telescopeSite
+            else:
+                raise ValueError('bitmask must be None, "telescope" or "site", not %s' %(self.bitmask))
+            if len(self.bitNames) > 64:
+                raise ValueError('Cannot fit %d %ss in a 64 bit mask' %(len(self.bitNames), self.bitmask))
+            self.telescopeBits = telescopeBits
+            # The bits set when each site can follow up a visit.
+            self.siteBits = np.zeros(len(self.sites), np.uint64)
+            for site, bit in zip(self.telescopeSite, telescopeBits):
+                self.siteBits[site] |= np.uint64(1) << np.uint64(bit)
+            self.colsAdded.append('followBitmask')
+            self.colsAddedDtypes.append(np.uint64)
+            self.units.append('')
 
-    def run(self, simData):
-        # Add new columns to simData.
-        simData = self._addStackers(simData)
-        simData['nObservatories'] = 0
+    def selectionMask(self, names):
+        """
+        Return the uint64 mask of the followBitmask bits of the named telescopes, to pass to countBits.
+        With bitmask='site', this is the mask of their sites.
+        """
+        mask = np.uint64(0)
+        for name in names:
+            index = np.where(self.telescopes['name'] == name)[0]
+            if len(index) == 0:
+                raise ValueError('Unknown telescope %s' %(name))
+            mask |= np.uint64(1) << np.uint64(self.telescopeBits[index[0]])
+        return mask
 
-        for obs in self.telescopes:
-            obsCount = simData['nObservatories']*0
+    def _siteVisibility(self, ra, dec, expMJD):
+        """
+        Return a boolean array (sites x visits), true where the visit can be followed up from the site
+        at any of the time steps.
+        """
+        visible = np.zeros((len(self.sites), len(ra)), bool)
+        for i, site in enumerate(self.sites):
+            # Only the visits not yet visible at an earlier time step need to be computed again.
+            pending = np.arange(len(ra))
             for step in self.timeSteps:
-                alt,az,pa = altAzPaFromRaDec(simData[self.raCol], simData[self.decCol],
-                                             np.radians(obs['lon']), np.radians(obs['lat']),
-                                             simData[self.expMJDCol]+step/24.)
+                if len(pending) == 0:
+                    break
+                alt,az,pa = altAzPaFromRaDec(ra[pending], dec[pending],
+                                             np.radians(site['lon']), np.radians(site['lat']),
+                                             expMJD[pending]+step/24.)
                 airmass = 1./(np.cos(np.pi/2.-alt))
-                good = np.where((airmass <= self.airmassLimit) & (airmass >= 1.) )
-                obsCount[good] = 1
+                good = (airmass <= self.airmassLimit) & (airmass >= 1.)
+                visible[i, pending[good]] = True
+                pending = pending[~good]
+        return visible
+
+    def _follow(self, ra, dec, expMJD, nObservatories, followBitmask):
+        """
+        Fill nObservatories (and followBitmask, unless None) for a block of visits.
+        """
+        visible = self._siteVisibility(ra, dec, expMJD)
+        # Credit all the telescopes at a site together.
+        nObservatories[:] = np.dot(self.siteMultiplicity, visible)
+        if followBitmask is not None:
+            followBitmask[:] = 0
+            for i in range(len(self.sites)):
+                followBitmask[visible[i]] |= self.siteBits[i]
 
-            simData['nObservatories'] += obsCount
+    def run(self, simData):
+        # Add new columns to simData.
+        simData = self._addStackers(simData)
+        ra = simData[self.raCol]
+        dec = simData[self.decCol]
+        expMJD = simData[self.expMJDCol]
+        nVisits = len(simData)
+        chunkSize = self.chunkSize
+        if chunkSize is None:
+            chunkSize = max(int(np.ceil(nVisits/float(self.nProcesses))), 1)
+        chunks = [(start, min(start+chunkSize, nVisits)) for start in range(0, nVisits, chunkSize)]
 
+        if self.nProcesses <= 1 or len(chunks) <= 1:
+            nObservatories = np.zeros(nVisits, np.int64)
+            followBitmask = None if self.bitmask is None else np.zeros(nVisits, np.uint64)
+            for start, stop in chunks:
+                self._follow(ra[start:stop], dec[start:stop], expMJD[start:stop], nObservatories[start:stop],
+                             None if followBitmask is None else followBitmask[start:stop])
+        else:
+            # The workers write their blocks straight into arrays shared with this process.
+            sharedCount = multiprocessing.RawArray(ctypes.c_int64, nVisits)
+            sharedBitmask = None
+            if self.bitmask is not None:
+                sharedBitmask = multiprocessing.RawArray(ctypes.c_uint64, nVisits)
+            pool = multiprocessing.Pool(self.nProcesses, _initWorker,
+                                        (self, ra, dec, expMJD, sharedCount, sharedBitmask))
+            try:
+                pool.map(_followChunk, chunks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+            nObservatories = np.frombuffer(sharedCount, np.int64)
+            followBitmask = None if sharedBitmask is None else np.frombuffer(sharedBitmask, np.uint64)
 
+        simData['nObservatories'] = nObservatories
+        if followBitmask is not None:
+            simData['followBitmask'] = followBitmask
         return simData
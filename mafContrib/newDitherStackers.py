@@ -15,6 +15,8 @@
 import numpy as np
 from lsst.sims.maf.stackers import BaseStacker
 from mafContrib.SeasonStacker_v2 import SeasonStacker_v2 as SeasonStacker
+from mafContrib.ditherPatterns import ditherOffsets, randomHexOffsets, repulsiveRandomHexOffsets
+from mafContrib.batchSlices import groupStarts
 
 __all__ = ['RandomDitherFieldPerVisitStacker',
            'RepulsiveRandomDitherFieldPerVisitStacker',
@@ -31,7 +33,8 @@ __all__ = ['RandomDitherFieldPerVisitStacker',
            'PentagonDitherFieldPerSeasonStacker',
            'PentagonDiamondDitherFieldPerSeasonStacker',
            'PentagonDitherPerSeasonStacker',
-           'PentagonDiamondDitherPerSeasonStacker']
+           'PentagonDiamondDitherPerSeasonStacker',
+           'MultiDitherStacker']
 
 def wrapRADec(ra, dec):
     """
@@ -49,6 +52,24 @@ def wrapRADec(ra, dec):
     ra = ra % (2.0*np.pi)
     return ra, dec
 
+def rankInField(fieldIds, key=None):
+    """
+    Return, for each visit, the rank of its key (e.g. its night), or of the visit itself if key is None,
+    among the (unique, sorted) keys of the visits to the same field.
+    """
+    if key is None:
+        order = np.argsort(fieldIds, kind='mergesort')
+        newGroup = np.ones(len(order), bool)
+    else:
+        order = np.lexsort((key, fieldIds))
+        newGroup = groupStarts(key[order])
+    fieldIds = fieldIds[order]
+    newField = groupStarts(fieldIds)
+    groupId = np.cumsum(newGroup | newField) - 1
+    rank = np.empty(len(order), int)
+    rank[order] = groupId - groupId[newField][np.cumsum(newField) - 1]
+    return rank
+
 def wrapRA(ra):
     """
     Wrap only RA values into 0-2pi (using mod).
@@ -56,19 +77,6 @@ def wrapRA(ra):
     ra = ra % (2.0*np.pi)
     return ra
 
-def polygonCoords(nside,radius, rotationAngle):
-    """
-    Find the x,y coords of a polygon.
-    """
-    eachAngle= 2*np.pi/nside
-    xCoords= np.zeros(nside, float)
-    yCoords= np.zeros(nside, float)
-    for i in range(0,nside):
-        xCoords[i]= np.sin(eachAngle*i + rotationAngle)*radius
-        yCoords[i]= np.cos(eachAngle*i + rotationAngle)*radius
-        
-    return zip(xCoords,yCoords)
-
 ######################################################################################################
 ######################################################################################################
 # Type 1
@@ -92,32 +100,7 @@ class RandomDitherFieldPerVisitStacker(BaseStacker):
         self.colsReq = [self.raCol, self.decCol]
 
     def _generateRandomOffsets(self, noffsets):
-        numPoints= noffsets*2
-        dithersRad = np.sqrt(np.random.rand(numPoints))*self.maxDither
-        dithersTheta = np.random.rand(numPoints)*np.pi*2.0
-
-        xOff = dithersRad * np.cos(dithersTheta)
-        yOff = dithersRad * np.sin(dithersTheta)
-           
-        # set up the hexagon: y=mx+b fortmat. 2h is the height.
-        b= np.sqrt(3.0)*self.maxDither
-        m= np.sqrt(3.0)
-        h= self.maxDither*np.sqrt(3.0)/2.0
-        
-        # get the points that are inside hexagon
-        index= np.where((yOff < m*xOff+b) &
-                        (yOff > m*xOff-b) &
-                        (yOff < -m*xOff+b) &
-                        (yOff > -m*xOff-b) &
-                        (yOff < h) &
-                        (yOff > -h))[0]
-                        
-        if (len(index) < noffsets):
-            print 'PROBLEM: not enough random points within the hexagon'
-            print 'Need ', str(noffsets), 'but have only ', str(len(index)), 'points. Rerun with a different seed?'
-        else:
-            self.xOff = xOff[index[0:noffsets]]
-            self.yOff = yOff[index[0:noffsets]]
+        self.xOff, self.yOff = randomHexOffsets(noffsets, self.maxDither)
 
     def run(self, simData):
         # Generate random numbers for dither, using defined seed value if desired.
@@ -157,125 +140,7 @@ class RepulsiveRandomDitherFieldPerVisitStacker(BaseStacker):
         self.colsReq = [self.raCol, self.decCol]
 
     def _generateRepRandomOffsets(self, noffsets):
-        # Strategy: Tile the circumscribing square with squares. Discard those that fall outside the hexagon.
-        # Then choose a square repulsive-randomly, and choose a random point from the chosen square.
-        
-        squareSide= self.maxDither*2   # circumscribing square. center at (0,0)
-        numTiles= (np.ceil(np.sqrt(noffsets))+170)**2    # number of tiles. must be a perfect square.
-        tileSide= squareSide/ np.sqrt(numTiles)
-
-        xCenter= np.zeros(numTiles)   # x-coords of the tiles' center
-        yCenter= np.zeros(numTiles)   # y-coords of the tiles' center
-
-        # fill in x-coords
-        k= 0
-        xCenter[k]= -tileSide*((np.sqrt(numTiles)/2.0)-0.5)   # far left x-coord
-
-        temparr= []
-        temparr.append(k)
-        while (k < (numTiles-1)):
-            # fill xCoords for squares right above the x-axis
-            if (k < (np.sqrt(numTiles)-1)):
-                k+=1
-                xCenter[k]= xCenter[k-1]+tileSide
-                temparr.append(k)
-            else:
-                # fill xCoords for squares above/below the first layer of squares.
-                for m in temparr:
-                    k+=1
-                    xCenter[k]= xCenter[m]
-            
-        # fill in the y-coords
-        i= 0
-        while (i<numTiles):
-            # the highest y-center coord above the x-axis
-            if (i==0):
-                yCenter[i]= tileSide*((np.sqrt(numTiles)/2.0)-0.5)
-            # y-centers below the top one
-            else:
-                yCenter[i]= yCenter[i-1]-tileSide
-
-            i+=1
-            # assign horiztonally adjacent squares the same yCenter
-            for j in range(1,int(np.sqrt(numTiles))):
-                yCenter[i]= yCenter[i-1]
-                i+=1
-        
-        # set up the hexagon
-        b= np.sqrt(3.0)*self.maxDither
-        m= np.sqrt(3.0)
-        h= self.maxDither*np.sqrt(3.0)/2.0
-        
-        # find the points that are inside hexagon
-        insideHex= np.where((yCenter <= m*xCenter+b) &
-                            (yCenter >= m*xCenter-b) &
-                            (yCenter <= -m*xCenter+b) &
-                            (yCenter >= -m*xCenter-b) &
-                            (yCenter <= h) &
-                            (yCenter >= -h))[0]  
-        
-        numPointsInsideHex= len(insideHex)
-        print 'numPointsInsideHexagon: ', numPointsInsideHex
-        #print 'numPointsOutsideHex: ', numTiles-len(insideHex)
-        #print 'need offsets: ', noffsets
-        print 'total squares chosen: ', len(xCenter)
-        print 'Filling factor for repRandom (Number of points needed/Number of points in hexagon): ', float(noffsets)/numPointsInsideHex
-
-        # if too few points, stop
-        if (numPointsInsideHex < noffsets):
-            print 'ERROR: Must increase the number of tiling squares, numTiles'
-            stop
-
-        # keep only the points that are insside the hexagon
-        tempX= xCenter.copy()
-        tempY= yCenter.copy()
-        xCenter= []
-        yCenter= []
-        xCenter= list(tempX[insideHex])
-        yCenter= list(tempY[insideHex])
-        
-        # initiate the offsets' array
-        xOff= np.zeros(noffsets)
-        yOff= np.zeros(noffsets)
-
-        # randomly select a point from the insideHex points. assign a random offset from within that square and 
-        # then delete it from insideHex array
-        randNumsForLatticeSq= np.random.rand(noffsets*3)
-        index_sq= 0    # index for randNumsForLatticeSq
-    
-        randNumsForPointInSq= np.random.rand(noffsets*2)
-        index_pt= 0    # index for randNumsForPointInSq
-
-        randIndex= -1
-        
-        for q in range(0, noffsets):
-            randIndex= int(np.floor(randNumsForLatticeSq[index_sq]*numPointsInsideHex))
-
-            if (randIndex > len(xCenter)-1):    # make sure randIndex access an entry in x/yCenter
-                while (randIndex > len(xCenter)-1):  # keep choosing random index until get a valid one
-                    index_sq += 1
-                    if (index_sq > len(randNumsForLatticeSq)-1):
-                        print 'Increase the length of randNumsForLatticeSq array'
-                        stop
-                randIndex= int(np.floor(randNumsForLatticeSq[index_sq]*numPointsInsideHex))
-                index_sq += 1
-            else:
-                randIndex= int(np.floor(randNumsForLatticeSq[index_sq]*numPointsInsideHex))
-                index_sq += 1
-
-            # assign offsets
-            xOff[q]= xCenter[randIndex]+(randNumsForPointInSq[index_pt]-0.5)*tileSide
-            index_pt+=1
-            yOff[q]= yCenter[randIndex]+(randNumsForPointInSq[index_pt]-0.5)*tileSide
-            index_pt+=1
-
-            # remove the chosen square to add the repulsion effect
-            xCenter.remove(xCenter[randIndex])
-            yCenter.remove(yCenter[randIndex])
-            numPointsInsideHex-=1
-      
-        self.xOff = xOff
-        self.yOff = yOff
+        self.xOff, self.yOff = repulsiveRandomHexOffsets(noffsets, self.maxDither)
 
     def run(self, simData):
         # Generate random numbers for dither, using defined seed value if desired.
@@ -317,25 +182,8 @@ class SpiralDitherFieldPerVisitStacker(BaseStacker):
         self.colsReq = [self.raCol, self.decCol, self.fieldIdCol]
 
     def _generateSpiralOffsets(self):
-        # First generate a full archimedean spiral ..
-        theta = np.arange(0.0001, self.nCoils*np.pi*2., 0.001)
-        a = 0.85*self.maxDither/theta.max()
-        r = theta*a
-        # Then pick out equidistant points along the spiral.
-        arc = a / 2.0 *(theta * np.sqrt(1 + theta**2) + np.log(theta + np.sqrt(1 + theta**2)))
-        stepsize = arc.max()/float(self.numPoints)
-        arcpts = np.arange(0, arc.max(), stepsize)
-        arcpts = arcpts[0:self.numPoints]
-        rpts = np.zeros(self.numPoints, float)
-        thetapts = np.zeros(self.numPoints, float)
-        for i, ap in enumerate(arcpts):
-            diff = np.abs(arc - ap)
-            match = np.where(diff == diff.min())[0]
-            rpts[i] = r[match]
-            thetapts[i] = theta[match]
-        # Translate these r/theta points into x/y (ra/dec) offsets.
-        self.xOff = rpts * np.cos(thetapts)
-        self.yOff = rpts * np.sin(thetapts)
+        # Equidistant points along an archimedean spiral, shared with all other stackers using the same spiral.
+        self.xOff, self.yOff = ditherOffsets('spiral', self.maxDither, numPoints=self.numPoints, nCoils=self.nCoils)
 
     def run(self, simData):
         # Add the new columns to simData.
@@ -375,32 +223,9 @@ class SequentialHexDitherFieldPerVisitStacker(BaseStacker):
         self.colsReq = [self.raCol, self.decCol, self.fieldIdCol]    #*********************************************
 
     def _generateHexOffsets(self):
-        # Set up basics of dither pattern.
-        dith_level = 4
-        nrows = 2**dith_level
-        halfrows = int(nrows/2.)
-        # Calculate size of each offset
-        dith_size_x = 0.95*self.maxDither*2.0/float(nrows)
-        dith_size_y = 0.95*np.sqrt(3)*self.maxDither/float(nrows)  #sqrt 3 comes from hexagon
-        # Calculate the row identification number, going from 0 at center
-        nid_row = np.arange(-halfrows, halfrows+1, 1)
-        # and calculate the number of vertices in each row.
-        vert_in_row = np.arange(-halfrows, halfrows+1, 1)
-        # First calculate how many vertices we will create in each row.
-        total_vert = 0
-        for i in range(-halfrows, halfrows+1, 1):
-            vert_in_row[i] = (nrows+1) - abs(nid_row[i])
-            total_vert += vert_in_row[i]
-        self.numPoints = total_vert
-        self.xOff = []
-        self.yOff = []
-        # Calculate offsets over hexagonal grid.
-        for i in range(0, nrows+1, 1):
-            for j in range(0, vert_in_row[i], 1):
-                self.xOff.append(dith_size_x * (j - (vert_in_row[i]-1)/2.0))
-                self.yOff.append(dith_size_y * nid_row[i])
-        self.xOff = np.array(self.xOff)
-        self.yOff = np.array(self.yOff)
+        # Vertices of the hexagonal grid, shared with all other stackers using the same grid.
+        self.xOff, self.yOff = ditherOffsets('hex', self.maxDither)
+        self.numPoints = len(self.xOff)
 
     def run(self, simData):
         simData = self._addStackers(simData)
@@ -451,20 +276,11 @@ class RandomDitherFieldPerNightStacker(RandomDitherFieldPerVisitStacker):
         # Generate the random dither values, one per night.
         self._generateRandomOffsets(len(simData[self.raCol]))
 
-        delta= 0   # counter to ensure new random numbers are chosen every time
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-
-            # Apply dithers, increasing each night.
-            vertexIdxs = np.arange(0, len(match), 1)+delta
-            delta= delta + len(vertexIdxs)   # ensure that the same xOff/yOff entries are not chosen
-            nights = simData[self.nightCol][match]
-            vertexIdxs = np.searchsorted(np.unique(nights), nights)
-            vertexIdxs = vertexIdxs % len(self.xOff)            
-            simData['RandomDitherFieldPerNightRA'][match] = simData[self.raCol][match] + \
-                                                                self.xOff[vertexIdxs]/np.cos(simData[self.decCol][match])
-            simData['RandomDitherFieldPerNightDec'][match] = simData[self.decCol][match] + self.yOff[vertexIdxs]
+        # Apply dithers, increasing each night: the offset of each visit is the rank of its night
+        # among the nights its field was observed.
+        vertexIdxs = rankInField(simData[self.fieldIdCol], simData[self.nightCol]) % len(self.xOff)
+        simData['RandomDitherFieldPerNightRA'] = simData[self.raCol] + self.xOff[vertexIdxs]/np.cos(simData[self.decCol])
+        simData['RandomDitherFieldPerNightDec'] = simData[self.decCol] + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['RandomDitherFieldPerNightRA'], simData['RandomDitherFieldPerNightDec'] = \
                                 wrapRADec(simData['RandomDitherFieldPerNightRA'], simData['RandomDitherFieldPerNightDec'])
@@ -499,20 +315,11 @@ class RepulsiveRandomDitherFieldPerNightStacker(RepulsiveRandomDitherFieldPerVis
         # Generate the random dither values, one per night.
         self._generateRepRandomOffsets(len(simData[self.raCol]))
 
-        delta= 0   # counter to ensure new random numbers are chosen every time
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-
-            # Apply dithers, increasing each night.
-            vertexIdxs = np.arange(0, len(match), 1)+delta
-            delta= delta + len(vertexIdxs)   # ensure that the same xOff/yOff entries are not chosen
-            nights = simData[self.nightCol][match]
-            vertexIdxs = np.searchsorted(np.unique(nights), nights)
-            vertexIdxs = vertexIdxs % len(self.xOff)            
-            simData['RepulsiveRandomDitherFieldPerNightRA'][match] = simData[self.raCol][match] + \
-                                                                self.xOff[vertexIdxs]/np.cos(simData[self.decCol][match])
-            simData['RepulsiveRandomDitherFieldPerNightDec'][match] = simData[self.decCol][match] + self.yOff[vertexIdxs]
+        # Apply dithers, increasing each night: the offset of each visit is the rank of its night
+        # among the nights its field was observed.
+        vertexIdxs = rankInField(simData[self.fieldIdCol], simData[self.nightCol]) % len(self.xOff)
+        simData['RepulsiveRandomDitherFieldPerNightRA'] = simData[self.raCol] + self.xOff[vertexIdxs]/np.cos(simData[self.decCol])
+        simData['RepulsiveRandomDitherFieldPerNightDec'] = simData[self.decCol] + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['RepulsiveRandomDitherFieldPerNightRA'], simData['RepulsiveRandomDitherFieldPerNightDec'] = \
                                 wrapRADec(simData['RepulsiveRandomDitherFieldPerNightRA'], simData['RepulsiveRandomDitherFieldPerNightDec'])
@@ -537,17 +344,11 @@ class SpiralDitherFieldPerNightStacker(SpiralDitherFieldPerVisitStacker):
     def run(self, simData):
         simData = self._addStackers(simData)
         self._generateSpiralOffsets()
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-            # Apply a sequential dither, increasing each night.
-            vertexIdxs = np.arange(0, len(match), 1)
-            nights = simData[self.nightCol][match]
-            vertexIdxs = np.searchsorted(np.unique(nights), nights)
-            vertexIdxs = vertexIdxs % self.numPoints
-            simData['SpiralDitherFieldPerNightRA'][match] = simData[self.raCol][match] + \
-                                                                self.xOff[vertexIdxs]/np.cos(simData[self.decCol][match])
-            simData['SpiralDitherFieldPerNightDec'][match] = simData[self.decCol][match] + self.yOff[vertexIdxs]
+        # Apply dithers, increasing each night: the offset of each visit is the rank of its night
+        # among the nights its field was observed.
+        vertexIdxs = rankInField(simData[self.fieldIdCol], simData[self.nightCol]) % self.numPoints
+        simData['SpiralDitherFieldPerNightRA'] = simData[self.raCol] + self.xOff[vertexIdxs]/np.cos(simData[self.decCol])
+        simData['SpiralDitherFieldPerNightDec'] = simData[self.decCol] + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['SpiralDitherFieldPerNightRA'], simData['SpiralDitherFieldPerNightDec'] = \
                     wrapRADec(simData['SpiralDitherFieldPerNightRA'],  simData['SpiralDitherFieldPerNightDec'])
@@ -570,17 +371,11 @@ class SequentialHexDitherFieldPerNightStacker(SequentialHexDitherFieldPerVisitSt
     def run(self, simData):
         simData = self._addStackers(simData)
         self._generateHexOffsets()
-        for fieldid in np.unique(simData[self.fieldIdCol]):
-            # Identify observations of this field.
-            match = np.where(simData[self.fieldIdCol] == fieldid)[0]
-            # Apply a sequential dither, increasing each night.
-            vertexIdxs = np.arange(0, len(match), 1)
-            nights = simData[self.nightCol][match]
-            vertexIdxs = np.searchsorted(np.unique(nights), nights)
-            vertexIdxs = vertexIdxs % self.numPoints
-            simData['SequentialHexDitherFieldPerNightRA'][match] = simData[self.raCol][match] + \
-                                                                       self.xOff[vertexIdxs]/np.cos(simData[self.decCol][match])
-            simData['SequentialHexDitherFieldPerNightDec'][match] = simData[self.decCol][match] + self.yOff[vertexIdxs]
+        # Apply dithers, increasing each night: the offset of each visit is the rank of its night
+        # among the nights its field was observed.
+        vertexIdxs = rankInField(simData[self.fieldIdCol], simData[self.nightCol]) % self.numPoints
+        simData['SequentialHexDitherFieldPerNightRA'] = simData[self.raCol] + self.xOff[vertexIdxs]/np.cos(simData[self.decCol])
+        simData['SequentialHexDitherFieldPerNightDec'] = simData[self.decCol] + self.yOff[vertexIdxs]
         # Wrap into expected range.
         simData['SequentialHexDitherFieldPerNightRA'], simData['SequentialHexDitherFieldPerNightDec'] = \
           wrapRADec(simData['SequentialHexDitherFieldPerNightRA'], simData['SequentialHexDitherFieldPerNightDec'])
@@ -616,13 +411,11 @@ class RandomDitherPerNightStacker(RandomDitherFieldPerVisitStacker):
         # Add the new columns to simData.
         simData = self._addStackers(simData)
         # Generate the random dither values, one per night.
-        nights = np.unique(simData[self.nightCol])
+        nights, nightIdx = np.unique(simData[self.nightCol], return_inverse=True)
         self._generateRandomOffsets(len(nights))
         # Add to RA and dec values.
-        for n, x, y in zip(nights, self.xOff, self.yOff):
-            match = np.where(simData[self.nightCol] == n)[0]
-            simData['RandomDitherPerNightRA'][match] = simData[self.raCol][match] + x/np.cos(simData[self.decCol][match])
-            simData['RandomDitherPerNightDec'][match] = simData[self.decCol][match] + y
+        simData['RandomDitherPerNightRA'] = simData[self.raCol] + self.xOff[nightIdx]/np.cos(simData[self.decCol])
+        simData['RandomDitherPerNightDec'] = simData[self.decCol] + self.yOff[nightIdx]
         # Wrap RA/Dec into expected range.
         simData['RandomDitherPerNightRA'], simData['RandomDitherPerNightDec'] = \
                 wrapRADec(simData['RandomDitherPerNightRA'], simData['RandomDitherPerNightDec'])
@@ -656,13 +449,11 @@ class RepulsiveRandomDitherPerNightStacker(RepulsiveRandomDitherFieldPerVisitSta
         # Add the new columns to simData.
         simData = self._addStackers(simData)
         # Generate the random dither values, one per night.
-        nights = np.unique(simData[self.nightCol])
+        nights, nightIdx = np.unique(simData[self.nightCol], return_inverse=True)
         self._generateRepRandomOffsets(len(nights))
         # Add to RA and dec values.
-        for n, x, y in zip(nights, self.xOff, self.yOff):
-            match = np.where(simData[self.nightCol] == n)[0]
-            simData['RepulsiveRandomDitherPerNightRA'][match] = simData[self.raCol][match] + x/np.cos(simData[self.decCol][match])
-            simData['RepulsiveRandomDitherPerNightDec'][match] = simData[self.decCol][match] + y
+        simData['RepulsiveRandomDitherPerNightRA'] = simData[self.raCol] + self.xOff[nightIdx]/np.cos(simData[self.decCol])
+        simData['RepulsiveRandomDitherPerNightDec'] = simData[self.decCol] + self.yOff[nightIdx]
         # Wrap RA/Dec into expected range.
         simData['RepulsiveRandomDitherPerNightRA'], simData['RepulsiveRandomDitherPerNightDec'] = \
                 wrapRADec(simData['RepulsiveRandomDitherPerNightRA'], simData['RepulsiveRandomDitherPerNightDec'])
@@ -688,16 +479,11 @@ class SpiralDitherPerNightStacker(SpiralDitherFieldPerVisitStacker):
         simData = self._addStackers(simData)
         self._generateSpiralOffsets()
 
-        nights = np.unique(simData[self.nightCol])
+        # One vertex per night, in the order of the nights.
+        vertexIdxs = np.unique(simData[self.nightCol], return_inverse=True)[1] % self.numPoints
         # Add to RA and dec values.
-        vertexID= 0
-        for n in nights:
-            match = np.where(simData[self.nightCol] == n)[0]
-            vertexID= vertexID % self.numPoints
-            
-            simData['SpiralDitherPerNightRA'][match] = simData[self.raCol][match] + self.xOff[vertexID]/np.cos(simData[self.decCol][match])
-            simData['SpiralDitherPerNightDec'][match] = simData[self.decCol][match] + self.yOff[vertexID]
-            vertexID += 1
+        simData['SpiralDitherPerNightRA'] = simData[self.raCol] + self.xOff[vertexIdxs]/np.cos(simData[self.decCol])
+        simData['SpiralDitherPerNightDec'] = simData[self.decCol] + self.yOff[vertexIdxs]
         # Wrap RA/Dec into expected range.
         simData['SpiralDitherPerNightRA'], simData['SpiralDitherPerNightDec'] = \
                             wrapRADec(simData['SpiralDitherPerNightRA'],simData['SpiralDitherPerNightDec'])
@@ -723,15 +509,11 @@ class SequentialHexDitherPerNightStacker(SequentialHexDitherFieldPerVisitStacker
         # Generate the spiral dither values
         self._generateHexOffsets()
 
-        nights = np.unique(simData[self.nightCol])
+        # One vertex per night, in the order of the nights.
+        vertexIdxs = np.unique(simData[self.nightCol], return_inverse=True)[1] % self.numPoints
         # Add to RA and dec values.
-        vertexID= 0
-        for n in nights:
-            match = np.where(simData[self.nightCol] == n)[0]
-            vertexID= vertexID % self.numPoints
-            simData['SequentialHexDitherPerNightRA'][match] = simData[self.raCol][match] + self.xOff[vertexID]/np.cos(simData[self.decCol][match])
-            simData['SequentialHexDitherPerNightDec'][match] = simData[self.decCol][match] + self.yOff[vertexID]
-            vertexID += 1
+        simData['SequentialHexDitherPerNightRA'] = simData[self.raCol] + self.xOff[vertexIdxs]/np.cos(simData[self.decCol])
+        simData['SequentialHexDitherPerNightDec'] = simData[self.decCol] + self.yOff[vertexIdxs]
         # Wrap RA/Dec into expected range.
         simData['SequentialHexDitherPerNightRA'], simData['SequentialHexDitherPerNightDec'] = \
                             wrapRADec(simData['SequentialHexDitherPerNightRA'],simData['SequentialHexDitherPerNightDec'])
@@ -761,31 +543,19 @@ class PentagonDitherFieldPerSeasonStacker(BaseStacker):
         self.colsReq = [self.raCol, self.decCol, self.fieldIdCol, self.expMJDCol]
             
     def _generatePentagonOffsets(self):
-        # inner pentagon tuples
-        nside= 5
-        inner= polygonCoords(nside, self.maxDither/2.5, 0.0)
-        # outer pentagon tuples
-        outerTemp= polygonCoords(nside, self.maxDither/1.3, np.pi)
-        # reorder outer tuples' order
-        outer= []
-        outer[0:3]= outerTemp[2:5]
-        outer[4:6]= outerTemp[0:2]
-        # join inner and outer coordiantes' array
-        self.xOff= np.concatenate((zip(*inner)[0],zip(*outer)[0]), axis=0)
-        self.yOff= np.concatenate((zip(*inner)[1],zip(*outer)[1]), axis=0)
+        # Vertices of the two pentagons, shared with all other stackers using the same pentagons.
+        self.xOff, self.yOff = ditherOffsets('pentagon', self.maxDither)
 
     def run(self, simData):
         # find the seasons associated with each visit.
-        seasonSimData= SeasonStacker().run(simData)
-        seasons= seasonSimData['season']
+        years, seasons= SeasonStacker().computeSeasons(simData[self.expMJDCol], simData[self.raCol])
 
         # check how many entries in the >10 season
         ind= np.where(seasons > 9)[0]
         print 'Seasons to wrap ', np.unique(seasons[ind])
         # should be only 1 extra seasons ..
         if len(np.unique(seasons[ind])) > 1:
-            print 'ERROR: Too many seasons'
-            stop
+            raise ValueError('Too many seasons: %s' %(np.unique(seasons[ind])))
         # wrap the season around: 10th == 0th
         seasons[ind]= seasons[ind]%10
                 
@@ -832,27 +602,19 @@ class PentagonDiamondDitherFieldPerSeasonStacker(BaseStacker):
 
            
     def _generateOffsets(self):
-        # outer pentagon tuples
-        pentCoord= polygonCoords(5,self.maxDither/1.3, 0)
-        # inner diamond tuples
-        diamondCoord= polygonCoords(4, self.maxDither/2.5, np.pi/2)
-
-        # join inner and outer coordiantes' array + a point in the middle (origin)
-        self.xOff= np.concatenate(([0],zip(*diamondCoord)[0],zip(*pentCoord)[0]), axis=0)
-        self.yOff= np.concatenate(([0],zip(*diamondCoord)[1],zip(*pentCoord)[1]), axis=0)
+        # Vertices of the pentagon and diamond, shared with all other stackers using the same pattern.
+        self.xOff, self.yOff = ditherOffsets('pentagonDiamond', self.maxDither)
 
     def run(self, simData):
         # find the seasons associated with each visit.
-        seasonSimData= SeasonStacker().run(simData)
-        seasons= seasonSimData['season']
+        years, seasons= SeasonStacker().computeSeasons(simData[self.expMJDCol], simData[self.raCol])
 
         # check how many entries in the >10 season
         ind= np.where(seasons > 9)[0]
         print 'Seasons to wrap ', np.unique(seasons[ind])
         # should be only 1 extra seasons ..
         if len(np.unique(seasons[ind])) > 1:
-            print 'ERROR: Too many seasons'
-            stop
+            raise ValueError('Too many seasons: %s' %(np.unique(seasons[ind])))
         # wrap the season around: 10th == 0th
         seasons[ind]= seasons[ind]%10
             
@@ -893,9 +655,7 @@ class PentagonDitherPerSeasonStacker(PentagonDitherFieldPerSeasonStacker):
    
     def run(self, simData):
         # find the seasons associated with each visit.
-        seasonSimData= SeasonStacker().run(simData)
-        seasons= seasonSimData['season']
-        years= seasonSimData['year']
+        years, seasons= SeasonStacker().computeSeasons(simData[self.expMJDCol], simData[self.raCol])
         
         # check how many entries in the >10 season
         ind= np.where(seasons > 9)[0]
@@ -959,16 +719,14 @@ class PentagonDiamondDitherPerSeasonStacker(PentagonDiamondDitherFieldPerSeasonS
    
     def run(self, simData):
         # find the seasons associated with each visit.
-        seasonSimData= SeasonStacker().run(simData)
-        seasons= seasonSimData['season']
+        years, seasons= SeasonStacker().computeSeasons(simData[self.expMJDCol], simData[self.raCol])
         
         # check how many entries in the >10 season
         ind= np.where(seasons > 9)[0]
         print 'Seasons to wrap ', np.unique(seasons[ind])
         # should be only 1 extra seasons ..
         if len(np.unique(seasons[ind])) > 1:
-            print 'ERROR: Too many seasons'
-            stop
+            raise ValueError('Too many seasons: %s' %(np.unique(seasons[ind])))
         # wrap the season around: 10th == 0th
         seasons[ind]= seasons[ind]%10
         
@@ -993,5 +751,127 @@ class PentagonDiamondDitherPerSeasonStacker(PentagonDiamondDitherFieldPerSeasonS
                                                   simData['PentagonDiamondDitherPerSeasonDec'])
         return simData
 
+######################################################################################################
+######################################################################################################
+# Combined
+class MultiDitherStacker(BaseStacker):
+    """
+    Add the dithered RA/Dec columns of any number of the stackers above in a single pass, sharing the
+    field/night/season grouping and cos(dec) between them.
+
+    ditherSpecs is a list of dictionaries, one per pair of columns to add. Each one has a 'pattern'
+    ('Random', 'RepulsiveRandom', 'Spiral', 'SequentialHex', 'Pentagon' or 'PentagonDiamond') and a
+    'timescale' ('FieldPerVisit', 'FieldPerNight' or 'PerNight' for the first four patterns; 'FieldPerSeason'
+    or 'PerSeason' for the pentagons), and optionally 'maxDither' (degrees), 'randomSeed', 'numPoints' and
+    'nCoils', with the same defaults as the individual stackers. The columns are named, and filled, exactly
+    as by the corresponding individual stacker, e.g. SpiralDitherFieldPerNightRA/Dec.
+    """
+    timescales = {'Random': ['FieldPerVisit', 'FieldPerNight', 'PerNight'],
+                  'RepulsiveRandom': ['FieldPerVisit', 'FieldPerNight', 'PerNight'],
+                  'Spiral': ['FieldPerVisit', 'FieldPerNight', 'PerNight'],
+                  'SequentialHex': ['FieldPerVisit', 'FieldPerNight', 'PerNight'],
+                  'Pentagon': ['FieldPerSeason', 'PerSeason'],
+                  'PentagonDiamond': ['FieldPerSeason', 'PerSeason']}
+
+    def __init__(self, ditherSpecs, raCol='fieldRA', decCol='fieldDec', fieldIdCol='fieldID',
+                 nightCol='night', expMJDCol='expMJD'):
+        self.raCol = raCol
+        self.decCol = decCol
+        self.fieldIdCol = fieldIdCol
+        self.nightCol = nightCol
+        self.expMJDCol = expMJDCol
+        self.ditherSpecs = []
+        self.colsAdded = []
+        self.colsReq = [self.raCol, self.decCol]
+        for spec in ditherSpecs:
+            pattern, timescale = spec['pattern'], spec['timescale']
+            if timescale not in self.timescales.get(pattern, []):
+                raise ValueError('No %s dither pattern with timescale %s' %(pattern, timescale))
+            spec = {'pattern': pattern, 'timescale': timescale,
+                    # Convert maxDither from degrees (internal units for ra/dec are radians)
+                    'maxDither': np.radians(spec.get('maxDither', 1.75)),
+                    'randomSeed': spec.get('randomSeed', None),
+                    'numPoints': spec.get('numPoints', 60), 'nCoils': spec.get('nCoils', 5),
+                    'colRA': '%sDither%sRA' %(pattern, timescale),
+                    'colDec': '%sDither%sDec' %(pattern, timescale)}
+            self.ditherSpecs.append(spec)
+            self.colsAdded += [spec['colRA'], spec['colDec']]
+            # Values required for framework operation: this specifies the data columns required from the database.
+            colsReq = []
+            if timescale.startswith('Field') and (timescale != 'FieldPerVisit' or 'Random' not in pattern):
+                colsReq.append(self.fieldIdCol)
+            if timescale.endswith('Night'):
+                colsReq.append(self.nightCol)
+            if timescale.endswith('Season'):
+                colsReq.append(self.expMJDCol)
+            self.colsReq += [col for col in colsReq if col not in self.colsReq]
+        # self.units used for plot labels
+        self.units = ['rad', 'rad']*len(self.ditherSpecs)
+
+    def _seasons(self, simData):
+        # find the seasons associated with each visit, and wrap the season around: 10th == 0th
+        years, seasons = SeasonStacker().computeSeasons(simData[self.expMJDCol], simData[self.raCol])
+        pastNine = np.unique(seasons[seasons > 9])
+        seasons[seasons > 9] %= 10
+        return seasons, pastNine
 
-    
+    def run(self, simData):
+        # Add all the new columns to simData at once.
+        simData = self._addStackers(simData)
+        cosDec = np.cos(simData[self.decCol])
+        # The visit groupings, each computed only once and only if needed.
+        groupings = {}
+        for spec in self.ditherSpecs:
+            pattern, timescale = spec['pattern'], spec['timescale']
+            if timescale not in groupings:
+                if timescale == 'FieldPerVisit':
+                    groupings[timescale] = rankInField(simData[self.fieldIdCol])
+                elif timescale == 'FieldPerNight':
+                    groupings[timescale] = rankInField(simData[self.fieldIdCol], simData[self.nightCol])
+                elif timescale == 'PerNight':
+                    groupings[timescale] = np.unique(simData[self.nightCol], return_inverse=True)[1]
+                else:
+                    if 'seasons' not in groupings:
+                        groupings['seasons'], groupings['seasonsPast9'] = self._seasons(simData)
+                    if timescale == 'FieldPerSeason':
+                        groupings[timescale] = rankInField(simData[self.fieldIdCol], groupings['seasons'])
+                    else:
+                        groupings[timescale] = np.unique(groupings['seasons'], return_inverse=True)[1]
+            # As in the individual stackers, the season patterns allow only one season past season 9 before
+            # wrapping, except PentagonDitherPerSeasonStacker, which wraps any number of them.
+            if timescale.endswith('Season') and (pattern, timescale) != ('Pentagon', 'PerSeason') and \
+                    len(groupings['seasonsPast9']) > 1:
+                raise ValueError('Too many seasons: %s' %(groupings['seasonsPast9']))
+            vertexIdxs = groupings[timescale]
+
+            # Generate the offsets.
+            if 'Random' in pattern:
+                # Generate random numbers for dither, using defined seed value if desired.
+                if spec['randomSeed'] is not None:
+                    np.random.seed(spec['randomSeed'])
+                if timescale == 'PerNight':
+                    noffsets = vertexIdxs.max() + 1 if len(vertexIdxs) > 0 else 0
+                else:
+                    noffsets = len(simData)
+                if pattern == 'Random':
+                    xOff, yOff = randomHexOffsets(noffsets, spec['maxDither'])
+                else:
+                    xOff, yOff = repulsiveRandomHexOffsets(noffsets, spec['maxDither'])
+                if timescale == 'FieldPerVisit':
+                    # A different offset per visit, in the order of the visits.
+                    vertexIdxs = np.arange(len(simData))
+            elif pattern == 'Spiral':
+                xOff, yOff = ditherOffsets('spiral', spec['maxDither'], numPoints=spec['numPoints'],
+                                           nCoils=spec['nCoils'])
+            elif pattern == 'SequentialHex':
+                xOff, yOff = ditherOffsets('hex', spec['maxDither'])
+            elif pattern == 'Pentagon':
+                xOff, yOff = ditherOffsets('pentagon', spec['maxDither'])
+            else:
+                xOff, yOff = ditherOffsets('pentagonDiamond', spec['maxDither'])
+            vertexIdxs = vertexIdxs % len(xOff)
+
+            # Add to RA and dec values, and wrap into expected range.
+            simData[spec['colRA']], simData[spec['colDec']] = \
+                wrapRADec(simData[self.raCol] + xOff[vertexIdxs]/cosDec, simData[self.decCol] + yOff[vertexIdxs])
+        return simData
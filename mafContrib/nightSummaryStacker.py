@@ -0,0 +1,99 @@
+import numpy as np
+from lsst.sims.maf.stackers import BaseStacker
+from .filterCodeStacker import filterCodes
+from .batchSlices import groupStarts
+
+__all__ = ['NightSummaryStacker', 'filterBitCounts']
+
+# Number of filters set in each possible filter bitmask.
+filterBitCounts = np.array([bin(mask).count('1') for mask in range(256)])
+
+class NightSummaryStacker(BaseStacker):
+    """
+    Summarize the visits to each field on each night, once, so that night-level metrics can work
+    on the (roughly ten times fewer) nights instead of the visits.
+
+    The summary is kept in self.summary, with one row per (field, night, season): fieldID, night,
+    season, nVisits, filterMask (bit i set if the i-th filter of filters was used, and bit
+    len(filters) if any other filter was), firstMJD and lastMJD. A night that crosses a season
+    boundary gets one row per season. The added column nightSummaryId gives each visit's row in it.
+
+    Metrics read the summary through this stacker instance, so the same instance must be passed to
+    the metric and included in the metric bundle's stackerList. The summary only describes slices
+    made of whole rows, i.e. field-based slicers (or slicers without dithering); sliceRows raises
+    a ValueError for a slice holding only some of the visits of a row.
+    """
+    def __init__(self, fieldIdCol='fieldID', nightCol='night', filterCol='filter', expMJDCol='expMJD',
+                 seasonCol='season', filters='ugrizy'):
+        self.fieldIdCol = fieldIdCol
+        self.nightCol = nightCol
+        self.filterCol = filterCol
+        self.expMJDCol = expMJDCol
+        self.seasonCol = seasonCol
+        if len(filters) > 7:
+            raise ValueError('Cannot fit %d filters in an 8 bit filter mask' %(len(filters)))
+        self.filters = filters
+        # Names of columns we want to add.
+        self.colsAdded = ['nightSummaryId']
+        self.colsAddedDtypes = [int]
+        # Names of columns we need from database.
+        self.colsReq = [fieldIdCol, nightCol, filterCol, expMJDCol, seasonCol]
+        # List of units for our new columns.
+        self.units = ['']
+        self.summary = None
+
+    def run(self, simData):
+        # Add new columns to simData.
+        simData = self._addStackers(simData)
+        # Sort the visits by field, night, season and time once, and find where each row begins.
+        order = np.lexsort((simData[self.expMJDCol], simData[self.seasonCol], simData[self.nightCol],
+                            simData[self.fieldIdCol]))
+        fields = simData[self.fieldIdCol][order]
+        nights = simData[self.nightCol][order]
+        seasons = simData[self.seasonCol][order]
+        newRow = groupStarts(fields, nights, seasons)
+        start = np.where(newRow)[0]
+        end = np.concatenate((start[1:], [len(order)])) - 1
+        # Translate the filters into bits, comparing the filter strings just once. Any other filter
+        # gets the bit after the named ones, as with the filter codes.
+        codes = filterCodes(simData[self.filterCol], self.filters)
+        filterBits = np.left_shift(1, codes).astype(np.uint8)
+
+        summary = np.zeros(len(start), dtype=[('fieldID', fields.dtype), ('night', nights.dtype),
+                                              ('season', seasons.dtype), ('nVisits', int),
+                                              ('filterMask', np.uint8),
+                                              ('firstMJD', float), ('lastMJD', float)])
+        summary['fieldID'] = fields[start]
+        summary['night'] = nights[start]
+        summary['season'] = seasons[start]
+        summary['nVisits'] = end - start + 1
+        summary['filterMask'] = np.bitwise_or.reduceat(filterBits[order], start)
+        summary['firstMJD'] = simData[self.expMJDCol][order][start]
+        summary['lastMJD'] = simData[self.expMJDCol][order][end]
+        self.summary = summary
+
+        simData['nightSummaryId'][order] = np.cumsum(newRow) - 1
+        return simData
+
+    def sliceRows(self, ids):
+        """
+        Return the summary rows of the visits with summary ids ids (e.g. one data slice), checking
+        that they hold all the visits of each of these rows.
+        """
+        if self.summary is None:
+            raise ValueError('The night summary has not been built: the same NightSummaryStacker instance '
+                             'must be in the stackerList of the bundle that runs this metric')
+        rowIds, nVisits = np.unique(ids, return_counts=True)
+        rows = self.summary[rowIds]
+        self.checkWholeRows(rows, nVisits)
+        return rows
+
+    def checkWholeRows(self, rows, nVisits):
+        """
+        Raise a ValueError unless nVisits (the number of visits found for each of the summary rows rows)
+        is the number of visits of each row.
+        """
+        if np.any(nVisits != rows['nVisits']):
+            raise ValueError('The data slice holds only some of the visits of a field on a night: '
+                             'the night summary can only be used with field-based slicers (or '
+                             'without dithering)')
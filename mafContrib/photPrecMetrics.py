@@ -5,6 +5,8 @@ Authors: Sergey Koposov, Thomas Collett
 
 import numpy as np
 from lsst.sims.maf.metrics import BaseMetric
+from .slicePointCache import checkCacheKey, cachedProduct
+from .batchSlices import sliceIds
 
 
 # This is needed to avoid an error when a metric is redefined
@@ -25,6 +27,25 @@ class RelRmsMetric(BaseMetric):
 	# the metric which computed the RMS over median
 	def run(self, dataSlice, slicePoint=None):
 		return np.std(dataSlice[self.colname])/np.median(dataSlice[self.colname])
+
+	def runBatch(self, dataSlices, offsets):
+		# the metric values of many slices at once: slice i is dataSlices[offsets[i]:offsets[i+1]]
+		offsets = np.asarray(offsets)
+		nSlices = len(offsets)-1
+		counts = np.diff(offsets)
+		slices = sliceIds(offsets)
+		values = dataSlices[self.colname]
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = np.bincount(slices, weights=values, minlength=nSlices)/counts
+			std = np.sqrt(np.bincount(slices, weights=(values-mean[slices])**2, minlength=nSlices)/counts)
+			# the median is the middle value (or the mean of the two middle values) of each sorted slice
+			values = values[np.lexsort((values, slices))]
+			median = np.zeros(nSlices) + np.nan
+			full = counts > 0
+			low = values[(offsets[:-1] + (counts-1)//2)[full]]
+			high = values[(offsets[:-1] + counts//2)[full]]
+			median[full] = 0.5*(low + high)
+			return std/median
 		
 
 class SNMetric(BaseMetric):
@@ -41,25 +62,38 @@ class SNMetric(BaseMetric):
 				metricName='SNMetric',
 				filter=None,
 				mag=None,
+				filterCodeCol=None,
+				slicePointCache=None,
+				slicerKey=None,
+				constraint=None,
 				 **kwargs):
 		"""Instantiate metric.
 
-		m5col = the column name of the individual visit m5 data."""
+		m5col = the column name of the individual visit m5 data.
+		filterCodeCol = optionally, the filter code column added by FilterCodeStacker,
+		to be used instead of the filter names.
+		slicePointCache = optionally, a SlicePointCache to share the per visit zeropoints
+		and sky counts with the other SNMetrics in.
+		slicerKey, constraint = the slicer identity and sql constraint of the bundle
+		(both required with a slicePointCache)."""
+		checkCacheKey(slicePointCache, slicerKey, constraint)
+		self.filterCodeCol = filterCodeCol
+		self.slicePointCache = slicePointCache
+		self.slicerKey = slicerKey
+		self.constraint = constraint
+		if filterCodeCol is not None:
+			filterCol = filterCodeCol
 		super(SNMetric, self).__init__(col=[m5Col,finSeeCol,
 			skyBCol,expTCol,filterCol], metricName=metricName, **kwargs)
 		self.filter = filter
 		self.mag = mag
 
-	def run(self, dataSlice, slicePoint=None):
-		#print 'x'
+	def _skyAdu(self, dataSlice):
+		# the per visit zeropoints and sky counts, which do not depend on the magnitude or filter
 		npoints = len(dataSlice['finSeeing'])
 		seeing= dataSlice['finSeeing']
-		depth5 = dataSlice['fiveSigmaDepth']
-		#mag = depth5 
-		mag = self.mag
 
 		zpt0 = 25.85
-		curfilt = self.filter#'r'
 		zpts = {'u': zpt0,
 				'g': zpt0,
 				'r': zpt0,
@@ -67,22 +101,42 @@ class SNMetric(BaseMetric):
 				'z': zpt0,
 				'y': zpt0}
 
-		gain = 4.5
-
-		zptArr= np.zeros(npoints)
-		for filt in 'ugrizy':
-			zptArr[dataSlice['filter']==filt]=zpts[filt]
+		if self.filterCodeCol is not None:
+			# look the zeropoints up by filter code (unknown filters get 0, as below)
+			codes = dataSlice[self.filterCodeCol]
+			zptArr = np.array([zpts[filt] for filt in 'ugrizy'] + [0.])[codes]
+		else:
+			zptArr= np.zeros(npoints)
+			for filt in 'ugrizy':
+				zptArr[dataSlice['filter']==filt]=zpts[filt]
 		sky_mag_arcsec=dataSlice['filtSkyBrightness']
 		exptime = dataSlice['visitExpTime']
 		sky_adu = 10**(-(sky_mag_arcsec-zptArr)/2.5) * exptime
 		sky_adu = sky_adu * np.pi * seeing**2 # adu per seeing circle
+		return zptArr, sky_adu
+
+	def run(self, dataSlice, slicePoint=None):
+		#print 'x'
+		depth5 = dataSlice['fiveSigmaDepth']
+		#mag = depth5 
+		mag = self.mag
+		curfilt = self.filter#'r'
+
+		gain = 4.5
+
+		zptArr, sky_adu = cachedProduct(self.slicePointCache, self.slicerKey, slicePoint, 'SNMetric.skyAdu',
+										self.constraint, lambda: self._skyAdu(dataSlice))
+		exptime = dataSlice['visitExpTime']
 
 		source_fluxes = 10**(-mag/2.5)		
 		source_adu = 10**(-(mag-zptArr)/2.5)*exptime
 		err_adu = np.sqrt(source_adu+sky_adu)/np.sqrt(gain)
 		err_fluxes = err_adu * (source_fluxes/source_adu)
 
-		ind = dataSlice['filter']==curfilt
+		if self.filterCodeCol is not None:
+			ind = dataSlice[self.filterCodeCol]=='ugrizy'.find(curfilt)
+		else:
+			ind = dataSlice['filter']==curfilt
 		flux0 = source_fluxes
 		stack_flux_err=1./np.sqrt((1/err_fluxes[ind]**2).sum())
 		errMag = 2.5/np.log(10)*stack_flux_err/flux0
@@ -106,17 +160,26 @@ class SEDSNMetric(BaseMetric):
 				metricName='SEDSNMetric',
 				#filter=None,
 				mags=None,
+				filterCodeCol=None,
+				slicePointCache=None,
+				slicerKey=None,
+				constraint=None,
 				 **kwargs):
 		"""Instantiate metric.
 
-		m5col = the column name of the individual visit m5 data."""
+		m5col = the column name of the individual visit m5 data.
+		filterCodeCol = optionally, the filter code column added by FilterCodeStacker.
+		slicePointCache, slicerKey, constraint = optionally, passed on to the SNMetrics."""
+		if filterCodeCol is not None:
+			filterCol = filterCodeCol
 		super(SEDSNMetric, self).__init__(col=[m5Col,finSeeCol,
 			skyBCol,expTCol,filterCol], metricName=metricName, **kwargs)
 		self.mags=mags
 		self.metrics={}
 		
 		for curfilt, curmag in mags.iteritems():
-			self.metrics[curfilt]=SNMetric(mag=curmag,filter=curfilt)
+			self.metrics[curfilt]=SNMetric(mag=curmag,filter=curfilt,filterCodeCol=filterCodeCol,
+				slicePointCache=slicePointCache,slicerKey=slicerKey,constraint=constraint)
 		
 		#self.filter = filter
 		#self.mag = mag
@@ -153,13 +216,20 @@ class ThreshSEDSNMetric(BaseMetric):
 				snlim=20,
 				#filter=None,
 				mags=None,
+				filterCodeCol=None,
+				slicePointCache=None,
+				slicerKey=None,
+				constraint=None,
 				 **kwargs):
 		"""Instantiate metric."""
 
+		if filterCodeCol is not None:
+			filterCol = filterCodeCol
 		super(ThreshSEDSNMetric, self).__init__(col=[m5Col,finSeeCol,
 			skyBCol,expTCol,filterCol], metricName=metricName, **kwargs)
 		
-		self.xmet = SEDSNMetric(mags=mags)		
+		self.xmet = SEDSNMetric(mags=mags,filterCodeCol=filterCodeCol,
+			slicePointCache=slicePointCache,slicerKey=slicerKey,constraint=constraint)		
 		self.snlim = snlim
 		#self.filter = filter
 		#self.mag = mag
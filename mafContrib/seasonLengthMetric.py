@@ -4,6 +4,7 @@
 
 from lsst.sims.maf.metrics import BaseMetric
 import numpy as np
+from .batchSlices import sliceIds, seasonStatistics
 
 
 class SeasonLengthMetric(BaseMetric):
@@ -29,14 +30,30 @@ class SeasonLengthMetric(BaseMetric):
         super(SeasonLengthMetric, self).__init__(col=[self.seasonCol, self.expMJDCol], **kwargs)
 
     def run(self, dataSlice, slicePoint=None):
-        # Loop over the seasons:
-        uniqSeasons = np.unique(dataSlice[self.seasonCol])
-        length = []
-        for k in uniqSeasons:
-            # Extract this season's dates
-            condition = (dataSlice[self.seasonCol] == k)
-            # "ptp" finds the beginning and end of this season, and takes the difference
-            length.append(np.ptp(dataSlice[self.expMJDCol][condition]))
+        if len(dataSlice) == 0:
+            return self.badval
+        # The beginning and end of each season, and so its length:
+        seasonSlices, length, separations = seasonStatistics(dataSlice[self.seasonCol],
+                                                             expMJD=dataSlice[self.expMJDCol])
         return np.average(length) * (12.0/365.0) # in months
 
+    def runBatch(self, dataSlices, offsets):
+        """
+        Return the metric values of many slices at once: slice i is dataSlices[offsets[i]:offsets[i+1]].
+        """
+        nSlices = len(offsets)-1
+        if len(dataSlices) == 0:
+            # Every slice is empty, and run() gives badval for an empty slice.
+            return np.zeros(nSlices) + self.badval
+        # The length of each season of each slice:
+        seasonSlices, length, separations = seasonStatistics(dataSlices[self.seasonCol],
+                                                             expMJD=dataSlices[self.expMJDCol],
+                                                             slices=sliceIds(offsets))
+        # Average the season lengths of each slice:
+        nSeasons = np.bincount(seasonSlices, minlength=nSlices)
+        totalLength = np.bincount(seasonSlices, weights=length, minlength=nSlices)
+        result = np.zeros(nSlices) + self.badval
+        result[nSeasons > 0] = totalLength[nSeasons > 0] / nSeasons[nSeasons > 0] * (12.0/365.0) # in months
+        return result
+
 # ======================================================================
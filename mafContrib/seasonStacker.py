@@ -28,20 +28,16 @@ class SeasonStacker(BaseStacker):
         # And save the column names.
         self.expMJDCol = expMJDCol
         self.RACol = RACol
-                
-    def run(self, simData):
-        # Add new columns to simData.
-        simData = self._addStackers(simData)
-        # Define year number:
-        year = np.floor((simData[self.expMJDCol] - simData[self.expMJDCol][0]) / 365.25)
-        # BUG: the offset should be by the survey start date, not
-        # the first observation of this field...
-        
+
+    def firstSeasonBegan(self, RA):
+        """
+        Return the MJD at which the first season began for objects at RA (radians).
+        """
         # Define season by finding date at which this object's RA is
         # overhead at the middle of the night, and then checking 6
         # months either side. First get RA of Sun, when object is at mid
         # point of its season.
-        sunRA = simData[self.RACol]*rad2deg/15.0 - 12.0
+        sunRA = RA*rad2deg/15.0 - 12.0
         sunRA[np.where(sunRA < 0.0)] += 24.0
         # The Sun is at this RA when N months have passed since March
         # 21, where N = 0.5*SunRA. Let's work out the first date when
@@ -50,7 +46,17 @@ class SeasonStacker(BaseStacker):
         # Modified Julian Date at midnight on March 21st, 2014 was
         Equinox = 2456737.5 - 2400000.5
         daysSinceEquinox = 0.5*sunRA*(365.25/12.0)
-        firstSeasonBegan = Equinox + daysSinceEquinox - 0.5*365.25
+        return Equinox + daysSinceEquinox - 0.5*365.25
+
+    def run(self, simData):
+        # Add new columns to simData.
+        simData = self._addStackers(simData)
+        # Define year number:
+        year = np.floor((simData[self.expMJDCol] - simData[self.expMJDCol][0]) / 365.25)
+        # BUG: the offset should be by the survey start date, not
+        # the first observation of this field...
+        
+        firstSeasonBegan = self.firstSeasonBegan(simData[self.RACol])
         # Now we can compute the number of years since the first season 
         # began, and so assign a global integer season number:
         globalSeason = np.floor((simData[self.expMJDCol] - firstSeasonBegan)/365.25)
@@ -0,0 +1,76 @@
+###############################################################################################################
+# Motivation: without dithering, the HEALpix slicepoints that fall in the same opsim field get identical data
+# slices, and metrics that only look at the visits (not at the slicepoint position) repeat the same work for
+# each of them. A SliceMemo fingerprints the slices, so that the metric is computed once per distinct slice;
+# metrics opt in through DedupMetricMixin.
+###############################################################################################################
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ['sliceFingerprint', 'SliceMemo', 'DedupMetricMixin']
+
+def sliceFingerprint(dataSlice, cols):
+    """
+    Return a fingerprint (a hash) of the values of the columns cols in dataSlice: two slices with the same
+    fingerprint have the same values, in the same order, in those columns.
+    """
+    fingerprint = hashlib.sha1(str(len(dataSlice)))
+    for col in cols:
+        values = np.ascontiguousarray(dataSlice[col])
+        fingerprint.update('%s:%s:' %(col, values.dtype.str))
+        fingerprint.update(values.tobytes())
+    return fingerprint.hexdigest()
+
+class SliceMemo(object):
+    """
+    Remember the metric values computed for the last maxSize distinct data slices (by fingerprint of the
+    columns cols), and reuse them for identical slices.
+
+    Only for metrics whose value depends on nothing but those columns of the slice (not, e.g., on the
+    slicepoint position). Identical slices get the very same value object back.
+    """
+    def __init__(self, cols, maxSize=1000):
+        if maxSize < 1:
+            raise ValueError('maxSize must be at least 1, not %s' %(maxSize))
+        self.cols = list(cols)
+        self.maxSize = maxSize
+        self._values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def evaluate(self, dataSlice, compute):
+        """
+        Return the value remembered for dataSlice, or compute() it and remember it.
+        """
+        key = sliceFingerprint(dataSlice, self.cols)
+        if key in self._values:
+            self.hits += 1
+            # Move the value to the most recently used end.
+            value = self._values.pop(key)
+        else:
+            self.misses += 1
+            value = compute()
+            if len(self._values) >= self.maxSize:
+                self._values.popitem(last=False)
+        self._values[key] = value
+        return value
+
+class DedupMetricMixin(object):
+    """
+    Give a metric a dedup keyword (default False): with dedup=True, identical data slices are only computed
+    once, through a SliceMemo on the metric's required columns.
+
+    Only for metrics whose value depends on nothing but their required columns (not on the slicepoint), so
+    e.g. CountMetric-like metrics using the slicepoint position must not use it. A metric opts in by listing
+    the mixin before BaseMetric in its bases and renaming its run(dataSlice, slicePoint) to _run(dataSlice).
+    """
+    def __init__(self, *args, **kwargs):
+        dedup = kwargs.pop('dedup', False)
+        super(DedupMetricMixin, self).__init__(*args, **kwargs)
+        self.sliceMemo = SliceMemo(self.colNameArr) if dedup else None
+
+    def run(self, dataSlice, slicePoint=None):
+        if self.sliceMemo is None:
+            return self._run(dataSlice)
+        return self.sliceMemo.evaluate(dataSlice, lambda: self._run(dataSlice))
@@ -0,0 +1,103 @@
+###############################################################################################################
+# Motivation: metrics run on the same slicepoints often compute the same intermediate products (e.g. the
+# coadded depth is needed by GalaxyCountsMetric as well as by a standalone coadded depth metric). A
+# SlicePointCache shared between those metrics lets the first one publish the product and the others read it.
+###############################################################################################################
+from collections import OrderedDict
+from lsst.sims.maf.metrics import Coaddm5Metric
+
+__all__ = ['SlicePointCache', 'checkCacheKey', 'cachedProduct', 'CachedCoaddm5Metric']
+
+class SlicePointCache(object):
+    """
+    A size-bounded cache of intermediate results, shared by the metrics run on the same slicepoints.
+
+    Entries are keyed by (slicer key, slicepoint id, column, constraint), and the key must identify the data
+    the product was computed from, not just the slicepoint: a slicepoint id only means something for one
+    slicer. slicerKey identifies the slicer (e.g. 'HealpixSlicer(nside=128, fieldRA, fieldDec)': its type,
+    resolution and the RA/Dec columns it bins), column names the product and what it is computed from
+    (e.g. 'coaddm5(fiveSigmaDepth)'), and constraint is the sql constraint of the bundle, so products of
+    differently constrained slices (e.g. different filters) are kept apart. Once there are more than maxSize
+    entries, the least recently used ones are evicted.
+    """
+    def __init__(self, maxSize=10000):
+        if maxSize < 1:
+            raise ValueError('maxSize must be at least 1, not %s' %(maxSize))
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, slicerKey, sid, column, constraint, default=None):
+        key = (slicerKey, sid, column, constraint)
+        if key not in self._entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # Move the entry to the most recently used end.
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def put(self, slicerKey, sid, column, constraint, value):
+        key = (slicerKey, sid, column, constraint)
+        if key in self._entries:
+            del self._entries[key]
+        self._entries[key] = value
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+def checkCacheKey(cache, slicerKey, constraint):
+    """
+    Raise a ValueError if a cache is given without the slicerKey and constraint that identify the data
+    of the bundle (see SlicePointCache): the defaults would let bundles with different slicers or
+    constraints read each other's products.
+    """
+    if cache is None:
+        return
+    if slicerKey is None:
+        raise ValueError('A slicePointCache needs the slicerKey of the bundle\'s slicer '
+                         '(e.g. \'HealpixSlicer(nside=128, fieldRA, fieldDec)\')')
+    if constraint is None:
+        raise ValueError('A slicePointCache needs the sql constraint of the bundle (\'\' for none)')
+
+def cachedProduct(cache, slicerKey, slicePoint, column, constraint, compute):
+    """
+    Return the product column for this slicepoint from cache, or compute() and publish it there.
+    Without a cache, or a slicepoint id, just return compute().
+    """
+    if (cache is None) or (slicePoint is None) or ('sid' not in slicePoint):
+        return compute()
+    missing = object()
+    value = cache.get(slicerKey, slicePoint['sid'], column, constraint, missing)
+    if value is missing:
+        value = compute()
+        cache.put(slicerKey, slicePoint['sid'], column, constraint, value)
+    return value
+
+class CachedCoaddm5Metric(Coaddm5Metric):
+    """
+    The coadded depth, published to (and read from) a SlicePointCache as 'coaddm5(<m5Col>)'.
+    """
+    def __init__(self, m5Col='fiveSigmaDepth', slicePointCache=None, slicerKey=None, constraint=None, **kwargs):
+        """
+        slicePointCache: the SlicePointCache shared with the other metrics
+        slicerKey: the identity of the slicer of the bundle this metric is run in (required with a cache)
+        constraint: the sql constraint of the bundle this metric is run in (required with a cache)
+        """
+        super(CachedCoaddm5Metric, self).__init__(m5Col=m5Col, **kwargs)
+        checkCacheKey(slicePointCache, slicerKey, constraint)
+        self.slicePointCache = slicePointCache
+        self.slicerKey = slicerKey
+        self.constraint = constraint
+        self.cacheColumn = 'coaddm5(%s)' %(m5Col)
+
+    def run(self, dataSlice, slicePoint=None):
+        return cachedProduct(self.slicePointCache, self.slicerKey, slicePoint, self.cacheColumn, self.constraint,
+                             lambda: super(CachedCoaddm5Metric, self).run(dataSlice, slicePoint))
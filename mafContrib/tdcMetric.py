@@ -3,12 +3,38 @@
 # Lynne Jones (rhiannonlynne) <ljones@astro.washington.edu>
 # ======================================================================
 
+import numpy as np
 from lsst.sims.maf.metrics import BaseMetric
-from .campaignLengthMetric import CampaignLengthMetric
-from .seasonLengthMetric import SeasonLengthMetric
-from .meanNightSeparationMetric import MeanNightSeparationMetric
+from .sliceDedup import DedupMetricMixin
+from .batchSlices import seasonStatistics
 
-class TdcMetric(BaseMetric):
+def tdcStatistics(seasons, nights, expMJD):
+    """
+    Compute the campaign length (seasons), mean season length (months) and mean night separation (days)
+    of a set of visits in a single grouping, with the same results as the CampaignLengthMetric,
+    SeasonLengthMetric and MeanNightSeparationMetric.
+    """
+    seasonSlices, seaLength, seasonMeans = seasonStatistics(seasons, expMJD=expMJD, nights=nights)
+    # Count the seasons:
+    camp = len(seasonSlices)
+    # Average the end-to-end length of each season:
+    sea = np.average(seaLength) * (12.0/365.0) # in months
+    # Average the mean night separation of each season:
+    cad = np.average(seasonMeans) # in days
+    return camp, sea, cad
+
+def tdcPowerLaws(camp, sea, cad, cadNorm, seaNorm, campNorm):
+    """
+    Return the TDC accuracy, precision and rate for a campaign length camp (seasons), mean season length sea
+    (months) and mean night separation cad (days), with the normalizations cadNorm, seaNorm and campNorm
+    (numbers, or arrays to evaluate many normalizations at once).
+    """
+    accuracy = 0.06 * (seaNorm / sea) * (campNorm / camp)**(1.1)
+    precision = 4.0 * (cad/cadNorm)**(0.7) * (seaNorm/sea)**(0.3) * (campNorm/camp)**(0.6)
+    rate = 30. * (cadNorm/cad)**(0.4) * (sea/seaNorm)**(0.8) * (campNorm/camp)**(0.2)
+    return accuracy, precision, rate
+
+class TdcMetric(DedupMetricMixin, BaseMetric):
     
     def __init__(self, seasonCol='season', expMJDCol='expMJD', nightCol='night',
                  metricName = 'TDC', cadNorm=3., seaNorm=4., campNorm=5., badval=99, **kwargs):
@@ -16,28 +42,27 @@ class TdcMetric(BaseMetric):
         self.cadNorm = cadNorm
         self.seaNorm = seaNorm
         self.campNorm = campNorm
-        # Set up the individual metrics we want to run.
-        self.campaignLength = CampaignLengthMetric(seasonCol=seasonCol)
-        self.seasonLength = SeasonLengthMetric(seasonCol=seasonCol, expMJDCol=expMJDCol)
-        self.meanNightSeparation = MeanNightSeparationMetric(seasonCol=seasonCol, nightCol=nightCol)
-        # Pass cols needed from database to super, but we don't have to save them here (will not use in 'run').
+        self.seasonCol = seasonCol
+        self.expMJDCol = expMJDCol
+        self.nightCol = nightCol
         super(TdcMetric, self).__init__(col=[seasonCol, expMJDCol, nightCol], badval=badval,
                                         metricName = metricName, units = '%s' %('%'),
                                         **kwargs)
 
-    def run(self, dataSlice, slicePoint=None):
-        # Calculate accuracy from combined individual metrics. 
-        camp = self.campaignLength.run(dataSlice)
-        sea = self.seasonLength.run(dataSlice)
-        cad = self.meanNightSeparation.run(dataSlice)
+    def _run(self, dataSlice):
+        # Calculate accuracy from the campaign length, season length and night separation,
+        # which are all computed in one pass over the visits.
+        if len(dataSlice) == 0:
+            camp = sea = cad = 0
+        else:
+            camp, sea, cad = tdcStatistics(dataSlice[self.seasonCol], dataSlice[self.nightCol],
+                                           dataSlice[self.expMJDCol])
         if sea * cad * camp == 0:
             accuracy = self.badval
             precision = self.badval
             rate = 0.0
         else:
-            accuracy = 0.06 * (self.seaNorm / sea) * (self.campNorm / camp)**(1.1)
-            precision = 4.0 * (cad/self.cadNorm)**(0.7) * (self.seaNorm/sea)**(0.3) * (self.campNorm/camp)**(0.6)
-            rate = 30. * (self.cadNorm/cad)**(0.4) * (sea/self.seaNorm)**(0.8) * (self.campNorm/camp)**(0.2)
+            accuracy, precision, rate = tdcPowerLaws(camp, sea, cad, self.cadNorm, self.seaNorm, self.campNorm)
         return {'accuracy':accuracy, 'precision':precision, 'rate':rate}
 
 
@@ -50,3 +75,50 @@ class TdcMetric(BaseMetric):
     def reduceRate(self, metricValue):
         return metricValue['rate']
 
+
+
+class TdcSweepMetric(DedupMetricMixin, BaseMetric):
+    """
+    The TDC accuracy, precision and rate for a whole grid of (cadNorm, seaNorm, campNorm) normalizations.
+    The campaign length, season length and night separation are computed once per slicepoint, and the
+    TdcMetric power laws (tdcPowerLaws) are then evaluated for every combination of cadNorms, seaNorms and campNorms
+    in one broadcast. Returns a structured array with one row per combination, with fields
+    cadNorm, seaNorm, campNorm, accuracy, precision and rate.
+    """
+    def __init__(self, seasonCol='season', expMJDCol='expMJD', nightCol='night',
+                 metricName = 'TDCSweep', cadNorms=(3.,), seaNorms=(4.,), campNorms=(5.,), badval=99, **kwargs):
+        # Set up the grid of normalization values.
+        cadNorm, seaNorm, campNorm = np.meshgrid(np.asarray(cadNorms, float), np.asarray(seaNorms, float),
+                                                 np.asarray(campNorms, float), indexing='ij')
+        self.cadNorm = cadNorm.ravel()
+        self.seaNorm = seaNorm.ravel()
+        self.campNorm = campNorm.ravel()
+        self.seasonCol = seasonCol
+        self.expMJDCol = expMJDCol
+        self.nightCol = nightCol
+        super(TdcSweepMetric, self).__init__(col=[seasonCol, expMJDCol, nightCol], badval=badval,
+                                             metricName = metricName, units = '%s' %('%'),
+                                             metricDtype = 'object', **kwargs)
+
+    def _run(self, dataSlice):
+        result = np.zeros(len(self.cadNorm), dtype=[('cadNorm', float), ('seaNorm', float),
+                                                    ('campNorm', float), ('accuracy', float),
+                                                    ('precision', float), ('rate', float)])
+        result['cadNorm'] = self.cadNorm
+        result['seaNorm'] = self.seaNorm
+        result['campNorm'] = self.campNorm
+        # Compute the campaign length, season length and night separation only once ..
+        if len(dataSlice) == 0:
+            camp = sea = cad = 0
+        else:
+            camp, sea, cad = tdcStatistics(dataSlice[self.seasonCol], dataSlice[self.nightCol],
+                                           dataSlice[self.expMJDCol])
+        if sea * cad * camp == 0:
+            result['accuracy'] = self.badval
+            result['precision'] = self.badval
+            result['rate'] = 0.0
+        else:
+            # .. and evaluate the power laws for all the normalizations at once.
+            result['accuracy'], result['precision'], result['rate'] = \
+                tdcPowerLaws(camp, sea, cad, self.cadNorm, self.seaNorm, self.campNorm)
+        return result
@@ -5,6 +5,7 @@ import numpy as np
 from scipy.signal import lombscargle
 
 from lsst.sims.maf.metrics import BaseMetric
+from .sliceDedup import DedupMetricMixin
 
 def find_period_LS(times, mags, minperiod=2., maxperiod=35., nbinmax=10**5, verbose=False):
     """
@@ -39,7 +40,7 @@ def find_period_LS(times, mags, minperiod=2., maxperiod=35., nbinmax=10**5, verb
     # Return period of the bin with the max value in the periodogram
     return 1./f[idx]
 
-class PeriodDeviationMetric(BaseMetric):
+class PeriodDeviationMetric(DedupMetricMixin, BaseMetric):
     """
     Measure the percentage deviation of recovered periods for
     pure sine wave variability (in magnitude).
@@ -56,6 +57,7 @@ class PeriodDeviationMetric(BaseMetric):
         :param periodCheck: Period to use in the reduce function (days)
         :param meanMag: Mean value of the lightcurve
         :param amplitude: Amplitude of the variation (mags)
+        :param dedup: Compute identical data slices only once (they then share the random periods)
         """
         self.periodMin = periodMin
         self.periodMax = periodMax
@@ -67,11 +69,10 @@ class PeriodDeviationMetric(BaseMetric):
         self.amplitude = amplitude
         super(PeriodDeviationMetric, self).__init__(col, metricName=metricName, **kwargs)
 
-    def run(self, dataSlice, slicePoint=None):
+    def _run(self, dataSlice):
         """
         Run the PeriodDeviationMetric
         :param dataSlice: Data for this slice.
-        :param slicePoint: Metadata for the slice. (optional)
         :return: The error in the period estimated from a Lomb-Scargle periodogram
         """
 